@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import argparse
+import statistics
+
+from openai import OpenAI
+from ollama import Client
+
+from lib.utils import load_jsonl, resolve_messages
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payload_paths", type=str, nargs="+", required=True)
+    parser.add_argument("--api_type", type=str, default="ollama", choices=['ollama', 'vllm'])
+    parser.add_argument("--model", type=str, default="llama3.3:70b")
+    parser.add_argument("--base_url", type=str, default=None)
+    parser.add_argument("--num_subjects", type=int, default=50)
+    return parser.parse_args()
+
+
+def measure_prefill(client, api_type, model, payload):
+    """
+    Send the payload for a single output token and measure its prefill.
+    Ollama reports the prompt evaluation itself, which excludes the tokens reused from its cache;
+    for vLLM the request latency is used instead.
+    """
+    start_time = time.monotonic()
+    if api_type == "ollama":
+        response = client.chat(
+            model=model,
+            messages=resolve_messages(payload),
+            options={"temperature": payload["temperature"], "num_ctx": 8192, "num_predict": 1},
+        )
+        return {
+            "prefill_seconds": (response.prompt_eval_duration or 0) / 1e9,
+            "evaluated_prompt_tokens": response.prompt_eval_count or 0,
+            "latency_seconds": time.monotonic() - start_time,
+        }
+    completion = client.chat.completions.create(
+        model=model,
+        messages=resolve_messages(payload),
+        temperature=payload["temperature"],
+        max_tokens=1,
+    )
+    latency = time.monotonic() - start_time
+    details = getattr(completion.usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    return {
+        "prefill_seconds": latency,
+        "evaluated_prompt_tokens": completion.usage.prompt_tokens - cached_tokens,
+        "latency_seconds": latency,
+    }
+
+
+def main(args):
+    """
+    Benchmark the prefill time of payload files (e.g., of different test types) across a cohort, to measure
+    how much of each prompt the servers' prefix caches reuse. The requests are sent one at a time, as the
+    prefix caches reuse the previous requests; the first request of each payload file warms up the cache and is
+    reported separately.
+    """
+    if args.api_type == "ollama":
+        client = Client(host=args.base_url)
+    else:
+        client = OpenAI(api_key="EMPTY", base_url=args.base_url or "http://localhost:8000/v1")
+
+    results = []
+    for payload_path in args.payload_paths:
+        payloads = [payload for payload in load_jsonl(payload_path) if payload["test"] == 1][:args.num_subjects + 1]
+        warmup = measure_prefill(client, args.api_type, args.model, payloads[0])
+        measurements = [
+            measure_prefill(client, args.api_type, args.model, payload) for payload in payloads[1:]
+        ]
+        prefill_seconds = [m["prefill_seconds"] for m in measurements]
+        results.append({
+            "payload_path": payload_path,
+            "num_subjects": len(measurements),
+            "warmup_prefill_seconds": round(warmup["prefill_seconds"], 4),
+            "mean_prefill_seconds": round(statistics.mean(prefill_seconds), 4),
+            "median_prefill_seconds": round(statistics.median(prefill_seconds), 4),
+            "total_prefill_seconds": round(sum(prefill_seconds), 4),
+            "mean_evaluated_prompt_tokens": round(statistics.mean(m["evaluated_prompt_tokens"] for m in measurements), 1),
+        })
+
+    # Compare every payload file against the first one
+    baseline = results[0]["total_prefill_seconds"]
+    for result in results:
+        result["prefill_saving"] = round(1 - result["total_prefill_seconds"] / baseline, 4) if baseline > 0 else 0.0
+        print(result)
+
+    results_path = f"results/benchmarks/prefix_cache-{args.model}.json"
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Saved the benchmark results to '{results_path}'.")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    main(args)
@@ -1,41 +1,169 @@
 import os
+import json
 import argparse
 
 from lib.payload_creator import PayloadCreatorFactory
-from lib.api_executor import APIExecutorFactory
-from lib.response_evaluator import ResponseEvaluatorFactory
-from lib.utils import load_jsonl, sample_source_set
+from lib.api_executor import APIExecutorFactory, CascadeAPIExecutor
+from lib.response_evaluator import ResponseEvaluatorFactory, ClassificationMetrics
+from lib.snsb_scores import load_snsb_score_table
+from lib.triage import TriageClassifier, build_triage_responses
+from lib.CLONE.workflow import DiagnosticGuidelineSynthesizer
+from lib.utils import RecordStore, compute_text_hash, load_jsonl, sample_source_set
 
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--test_type", type=str, default="zeroshot", choices=['zeroshot', 'fewshot', 'custom'])
     parser.add_argument("--num_examples", type=int, default=0)
+    parser.add_argument("--example_selection", type=str, default="random", choices=['random', 'knn'])
     parser.add_argument("--source_ratio", type=float, default=0.1)
+    parser.add_argument("--guideline_path", type=str, default=None)
     parser.add_argument("--api_type", type=str, default="ollama", choices=['openai', 'ollama', 'vllm'])
     parser.add_argument("--api_key", type=str, default=os.getenv("OPENAI_API_KEY"))
     parser.add_argument("--temperature", type=float, default=0.1)
     parser.add_argument("--model", type=str, default="llama3.3:70b")
-    parser.add_argument("--batch", type=bool, default=False)
+    parser.add_argument("--batch", action="store_true")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--pipeline", action="store_true")
+    parser.add_argument("--triage", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=None)
+    parser.add_argument("--base_urls", type=str, nargs="+", default=None)
+    parser.add_argument("--cascade_model", type=str, default=None)
+    parser.add_argument("--cascade_base_urls", type=str, nargs="+", default=None)
+    parser.add_argument("--cascade_samples", type=int, default=3)
+    parser.add_argument("--cascade_threshold", type=float, default=1.0)
     parser.add_argument("--eval_type", type=str, default="clf", choices=['clf', 'rubric'])
     parser.add_argument("--baseline_type", type=str, default="zeroshot", choices=['zeroshot', 'fewshot1', 'fewshot2'])
     return parser.parse_args()
 
 
+def build_triage_report(triage, labels, test_subject_ids, response_list, full_response_list):
+    """
+    Compare the triage run (triage + LLM for the ambiguous subjects) with the LLM on every subject.
+    """
+    def get_metrics(responses, subject_ids):
+        metrics = ClassificationMetrics()
+        for subject_id in subject_ids:
+            if subject_id in responses:
+                metrics.update(labels[subject_id], responses[subject_id]["diagnosis"])
+        return metrics.compute()
+
+    responses, full_responses = RecordStore(response_list), RecordStore(full_response_list)
+    triaged_subject_ids = [s for s in test_subject_ids if responses.get(s, {}).get("triaged")]
+    report = {
+        "triage_rules": triage.describe(),
+        "num_subjects": len(test_subject_ids),
+        "num_triaged": len(triaged_subject_ids),
+        "num_llm_calls": len(test_subject_ids) - len(triaged_subject_ids),
+        "llm_call_reduction": round(len(triaged_subject_ids) / len(test_subject_ids), 4),
+        "triage_only": get_metrics(responses, triaged_subject_ids),
+        "triage_with_llm": get_metrics(responses, test_subject_ids),
+    }
+    # The LLM's metrics are only comparable if it has responded to every subject (e.g., in an earlier full run)
+    if all(s in full_responses for s in test_subject_ids):
+        report["llm_only"] = get_metrics(full_responses, test_subject_ids)
+        report["llm_on_triaged"] = get_metrics(full_responses, triaged_subject_ids)
+    else:
+        print("Run without --triage to compare with the LLM's metrics on every subject.")
+    return report
+
+
+def get_guideline_tag(diagnostic_guideline):
+    """
+    Get the tag of the custom payloads and responses built with the guideline.
+    """
+    return f"_{compute_text_hash(diagnostic_guideline)[:8]}"
+
+
+def build_cascade_report(cascade, labels, test_subject_ids, response_list, single_response_paths):
+    """
+    Compare the cascade with each of its models run alone, in calls and generated characters as a cost proxy.
+    Only the responses fetched from the API count towards the cost; those served from the response cache are
+    counted separately.
+    """
+    def get_metrics(responses):
+        metrics = ClassificationMetrics()
+        for subject_id in test_subject_ids:
+            if subject_id in responses:
+                metrics.update(labels[subject_id], responses[subject_id]["diagnosis"])
+        return metrics.compute()
+
+    small_model, large_model = cascade.small_executor.model, cascade.large_executor.model
+    escalated = [r for r in response_list if r["cascade_model"] == large_model]
+    fetched_responses = {
+        small_model: [r for r in cascade.sample_responses if not r.get("cached")],
+        large_model: [r for r in escalated if not r.get("cached")],
+    }
+    report = {
+        "small_model": small_model,
+        "large_model": large_model,
+        "num_samples": cascade.num_samples,
+        "threshold": cascade.threshold,
+        "num_subjects": len(test_subject_ids),
+        "num_escalated": len(escalated),
+        "escalation_rate": round(len(escalated) / max(len(test_subject_ids), 1), 4),
+        "num_calls": {model: len(responses) for model, responses in fetched_responses.items()},
+        "num_cached": {
+            small_model: len(cascade.sample_responses) - len(fetched_responses[small_model]),
+            large_model: len(escalated) - len(fetched_responses[large_model]),
+        },
+        "generated_chars": {
+            model: sum(len(r["generated_response"]) for r in responses) for model, responses in fetched_responses.items()
+        },
+        "cascade": get_metrics(RecordStore(response_list)),
+    }
+    # The single models' metrics are only comparable if they have responded to every subject (e.g., in earlier runs)
+    for model, response_path in single_response_paths.items():
+        single_responses = RecordStore(load_jsonl(response_path) if response_path and os.path.exists(response_path) else [])
+        if all(s in single_responses for s in test_subject_ids):
+            report[f"{model}_only"] = {
+                **get_metrics(single_responses),
+                "generated_chars": sum(len(single_responses[s]["generated_response"]) for s in test_subject_ids),
+            }
+        else:
+            print(f"Run '{model}' without --cascade_model to compare with its metrics on every subject.")
+    return report
+
+
 def main(args):
+    REPO_PATH = os.path.abspath(os.getcwd())
+    
     # ----------------------------------------------------------------------
-    # Define the paths
+    # Load the dataset
     # ----------------------------------------------------------------------
-    REPO_PATH = os.path.abspath(os.getcwd())
+    INFO_DATASET_PATH = f"{REPO_PATH}/data/processed/info.jsonl"
+    info_dataset = load_jsonl(INFO_DATASET_PATH)
+    
+    source_subject_ids, test_subject_ids = sample_source_set(info_dataset, source_ratio=args.source_ratio)
     
+    # ----------------------------------------------------------------------
+    # Get the diagnostic guideline
+    # ----------------------------------------------------------------------
+    # The custom payloads and responses are keyed by the guideline, so a guideline synthesized for
+    # another split (or given with --guideline_path) never reuses the payloads of an earlier one
+    diagnostic_guideline, GUIDELINE_TAG = None, ""
+    if args.test_type == "custom":
+        if args.guideline_path:
+            with open(args.guideline_path, "r") as f:
+                diagnostic_guideline = f.read()
+        else:
+            diagnostic_guideline = DiagnosticGuidelineSynthesizer(
+                args.model, max_concurrency=args.concurrency
+            ).synthesize_diagonstic_guideline(source_subject_ids)
+        GUIDELINE_TAG = get_guideline_tag(diagnostic_guideline)
+    
+    # ----------------------------------------------------------------------
+    # Define the paths
+    # ----------------------------------------------------------------------
     SYSTEM_PROMPT_PATH = f"{REPO_PATH}/prompts/system.txt"
     USER_PROMPT_TEMPLATE_PATH = f"{REPO_PATH}/prompts/user.txt"    
-    INFO_DATASET_PATH = f"{REPO_PATH}/data/processed/info.jsonl"
     
     if args.test_type == "fewshot":
-        TEST_PREFIX = f"{args.test_type}{args.num_examples}-{args.model}"
+        SELECTION_TAG = "_knn" if args.example_selection == "knn" else ""
+        TEST_NAME = f"{args.test_type}{args.num_examples}{SELECTION_TAG}"
     else:
-        TEST_PREFIX = f"{args.test_type}-{args.model}"
+        TEST_NAME = f"{args.test_type}{GUIDELINE_TAG}"
+    TEST_PREFIX = f"{TEST_NAME}-{args.model}"
     
     if args.test_type == "custom":
         input_payload_path = f'{REPO_PATH}/data/payloads/{TEST_PREFIX}.jsonl'
@@ -47,46 +175,95 @@ def main(args):
     else:
         baseline_response_path = None
         
-    output_path = f'{REPO_PATH}/results/{TEST_PREFIX}.output.jsonl'
-    eval_results_path = f'{REPO_PATH}/results/{TEST_PREFIX}.eval_results-{args.eval_type}.jsonl'
+    # The LLM's responses are shared with the runs without triage
+    TRIAGE_TAG = "-triage" if args.triage else ""
+    CASCADE_TAG = f"-cascade-{args.cascade_model}" if args.cascade_model else ""
+    output_path = f'{REPO_PATH}/results/{TEST_PREFIX}{CASCADE_TAG}.output.jsonl'
+    eval_results_path = f'{REPO_PATH}/results/{TEST_PREFIX}{CASCADE_TAG}.eval_results-{args.eval_type}{TRIAGE_TAG}.jsonl'
+    triage_report_path = f'{REPO_PATH}/results/{TEST_PREFIX}{CASCADE_TAG}.triage_report.json'
+    cascade_report_path = f'{REPO_PATH}/results/{TEST_PREFIX}{CASCADE_TAG}.cascade_report.json'
     
     # ----------------------------------------------------------------------
-    # Load the dataset
+    # Triage the clear-cut subjects
     # ----------------------------------------------------------------------
-    info_dataset = load_jsonl(INFO_DATASET_PATH)
-    
-    source_subject_ids, test_subject_ids = sample_source_set(info_dataset, source_ratio=args.source_ratio)
+    labels = {info_data["subject_id"]: info_data["group"] for info_data in info_dataset}
+    llm_subject_ids, triage_responses = test_subject_ids, []
+    if args.triage:
+        if args.eval_type != "clf":
+            raise ValueError("Triage is only supported for the classification evaluation.")
+        score_table = load_snsb_score_table(list(labels))
+        triage = TriageClassifier.fit(score_table, source_subject_ids, labels)
+        predictions = triage.predict(score_table, test_subject_ids)
+        triage_responses = build_triage_responses(test_subject_ids, predictions)
+        llm_subject_ids = [s for s, prediction in zip(test_subject_ids, predictions) if prediction == -1]
+        print(f"Triaged {len(triage_responses)} of {len(test_subject_ids)} subjects with {triage.describe()}.")
     
     # ----------------------------------------------------------------------
     # Create the payloads
     # ----------------------------------------------------------------------
-    input_payloads = PayloadCreatorFactory.get_payload_creator(
+    payload_creator = PayloadCreatorFactory.get_payload_creator(
         test_type=args.test_type,
         temperature=args.temperature,
         system_prompt_path=SYSTEM_PROMPT_PATH,
         user_prompt_template_path=USER_PROMPT_TEMPLATE_PATH
-    ).create_payload(
+    )
+    payload_kwargs = dict(
         info_dataset=info_dataset,
         payload_path=input_payload_path,
         num_examples=args.num_examples,
+        example_selection=args.example_selection,
         model=args.model,
         source_subject_ids=source_subject_ids,
+        diagnostic_guideline=diagnostic_guideline,
         test_subject_ids=test_subject_ids,
+        concurrency=args.concurrency,
     )
+    # In the pipeline mode, the payloads are created on demand while the API is executed
+    input_payloads = payload_creator.create_payload(**payload_kwargs, lazy=args.pipeline)
+    
+    running_metrics = ClassificationMetrics()
+    def update_running_metrics(payload, response):
+        running_metrics.update(payload["ground_truth"], response["diagnosis"])
+        if running_metrics.total % 50 == 0:
+            print(f"Running metrics: {running_metrics.compute()}")
     
     # ----------------------------------------------------------------------
     # Execute the API
     # ----------------------------------------------------------------------
-    response_list = APIExecutorFactory.get_api_executor(
+    api_executor = APIExecutorFactory.get_api_executor(
         model=args.model,
         api_type=args.api_type,
         api_key=args.api_key,
-    ).fetch_response(
+        concurrency=args.concurrency,
+        base_urls=args.base_urls,
+    )
+    # In the cascade mode, the cascade model answers first and only its uncertain subjects are escalated to the model
+    if args.cascade_model:
+        api_executor = CascadeAPIExecutor(
+            small_executor=APIExecutorFactory.get_api_executor(
+                model=args.cascade_model,
+                api_type=args.api_type,
+                api_key=args.api_key,
+                concurrency=args.concurrency,
+                base_urls=args.cascade_base_urls or args.base_urls,
+            ),
+            large_executor=api_executor,
+            num_samples=args.cascade_samples,
+            threshold=args.cascade_threshold,
+        )
+    response_list = api_executor.fetch_response(
         input_payloads=input_payloads,
-        test_subject_ids=test_subject_ids,
+        test_subject_ids=llm_subject_ids,
         response_path=output_path,
         batch=args.batch,
+        stream=args.stream,
+        on_response=update_running_metrics if args.pipeline and args.eval_type == "clf" else None,
     )
+    if args.pipeline:
+        # Reload the payloads, which are all cached by now, for the evaluation; the classification
+        # evaluation only reads their ground truths, so they are streamed from the cache
+        input_payloads = payload_creator.create_payload(**payload_kwargs, lazy=args.eval_type == "clf")
+    response_list = response_list + triage_responses
     
     # ----------------------------------------------------------------------
     # Evaluate the responses
@@ -104,6 +281,35 @@ def main(args):
     # Check the evaluation results
     print(eval_results)
     
+    if args.triage:
+        triage_report = build_triage_report(
+            triage, labels, test_subject_ids, response_list, load_jsonl(output_path) if os.path.exists(output_path) else []
+        )
+        with open(triage_report_path, "w") as f:
+            json.dump(triage_report, f, indent=4)
+        print(triage_report)
+    
+    if args.cascade_model:
+        # Each model's own custom run is keyed by the guideline it synthesized (unless one was given)
+        single_response_paths = {}
+        for model in (args.cascade_model, args.model):
+            test_name = TEST_NAME
+            if args.test_type == "custom" and not args.guideline_path:
+                guideline_path = DiagnosticGuidelineSynthesizer(model).get_guideline_path(source_subject_ids)
+                if not os.path.exists(guideline_path):
+                    single_response_paths[model] = None
+                    continue
+                with open(guideline_path, "r") as f:
+                    test_name = f"{args.test_type}{get_guideline_tag(f.read())}"
+            single_response_paths[model] = f'{REPO_PATH}/results/{test_name}-{model}.output.jsonl'
+        cascade_report = build_cascade_report(
+            api_executor, labels, llm_subject_ids, response_list[:len(response_list) - len(triage_responses)],
+            single_response_paths,
+        )
+        with open(cascade_report_path, "w") as f:
+            json.dump(cascade_report, f, indent=4)
+        print(cascade_report)
+    
 
 if __name__ == "__main__":
     args = get_args()
@@ -1,4 +1,6 @@
 import os
+import json
+import asyncio
 
 from langchain_openai import ChatOpenAI
 from langchain_ollama import ChatOllama
@@ -10,19 +12,54 @@ from .prompts import (
     DRAFT_GUIDELINES_PROMPT, 
     UNIFIED_GUIDELINE_PROMPT
 )
-from lib.utils import get_snsb_data_by_subject_id
+from lib.utils import get_snsb_data_by_subject_id, compute_text_hash, TextCache
+
+
+# Prompt of each stage, keyed by the name of the stage's chain
+STAGE_PROMPTS = {
+    "roleplaying": ROLE_PLAYING_PROMPT,
+    "drafting": DRAFT_GUIDELINES_PROMPT,
+    "writing": UNIFIED_GUIDELINE_PROMPT,
+}
 
 
 class DiagnosticGuidelineSynthesizer:
-    def __init__(self, model: str = "llama3.3:70b", num_ctx: int = 8192):
+    default_max_concurrency = 8
+
+    def __init__(
+        self,
+        model: str = "llama3.3:70b",
+        num_ctx: int = 8192,
+        max_concurrency: int = None,
+        consolidation: str = "hierarchical",
+        max_output_tokens: int = 2048,
+        temperature: float = 0.1,
+        cache_dir: str = "results/guidelines/cache",
+        guideline_dir: str = "results/guidelines",
+    ):
+        if consolidation not in ("flat", "hierarchical"):
+            raise ValueError(f"Unsupported consolidation mode: {consolidation}.")
         self.model = model
+        self.num_ctx = num_ctx
+        self.max_concurrency = max_concurrency or self.default_max_concurrency
+        self.consolidation = consolidation
+        self.max_output_tokens = max_output_tokens
+        self.temperature = temperature
         self.llm = self._initialize_llm(model, num_ctx)
-        self.save_path = f"results/guidelines/{model}.txt"
+        self.guideline_dir = guideline_dir
+        
+        # Checkpoint caches of each stage's outputs
+        self.stage_caches = {
+            stage: TextCache(os.path.join(cache_dir, stage)) for stage in STAGE_PROMPTS
+        }
 
         # Chains for each stage of the guideline synthesis process
         self.roleplaying_chain = self._get_chain(ROLE_PLAYING_PROMPT)
         self.drafting_chain = self._get_chain(DRAFT_GUIDELINES_PROMPT)
-        self.writing_chain = self._get_chain(UNIFIED_GUIDELINE_PROMPT)
+        # The consolidated guidelines are capped at the output budget reserved in the next consolidation level
+        self.writing_chain = self._get_chain(
+            UNIFIED_GUIDELINE_PROMPT, self._initialize_llm(model, num_ctx, max_output_tokens)
+        )
     
     def synthesize_diagonstic_guideline(self, source_subject_ids):
         """
@@ -32,53 +69,137 @@ class DiagnosticGuidelineSynthesizer:
         Returns:
             str: Consolidated diagnostic guideline.
         """
-        if self._guideline_exists():
-            return self._load_existing_guideline()
+        guideline_key, guideline_metadata = self._get_guideline_key(source_subject_ids)
+        save_path = self.get_guideline_path(source_subject_ids)
+        if self._guideline_exists(save_path):
+            return self._load_existing_guideline(save_path)
         
         print("Synthesizing diagnostic guidelines...")
         snsb_scores, snsb_reports = self._load_snsb_data(source_subject_ids)      
         
-        # ---------------------------------------------------------------------
-        # Stage 1: Emulating Experts through Role-Playing
-        # ---------------------------------------------------------------------
-        answer_set = self.roleplaying_chain.batch(
-            [
-                {"snsb_score": snsb_score, "snsb_report": snsb_report}
-                for snsb_score, snsb_report in zip(snsb_scores, snsb_reports)
-            ]
-        )
+        diagnostic_guideline = asyncio.run(self._synthesize(snsb_scores, snsb_reports))
+        
+        # Save the generated guideline
+        self._save_guideline(diagnostic_guideline, guideline_metadata, save_path)
         
+        return diagnostic_guideline
+
+
+    async def _synthesize(self, snsb_scores, snsb_reports):
+        """
+        Runs the guideline synthesis stages.
+        """
         # ---------------------------------------------------------------------
-        # Stage 2: Synthesizing Step-by-Step Diagnostic Guidelines
+        # Stage 1 & 2: Emulating experts and synthesizing draft guidelines
         # ---------------------------------------------------------------------
-        drafts = self.drafting_chain.batch(
-            [
-                {"answer": answer} for answer in answer_set
-            ]
-        )
+        drafts = await self._draft_guidelines(snsb_scores, snsb_reports)
         
         # Consolidate the draft guidelines into a unified guideline
-        diagnostic_guideline = self.writing_chain.invoke(
-            {"draft_guidelines": "\n\n".join(drafts)}
+        if self.consolidation == "hierarchical":
+            return await self._consolidate_guidelines(drafts)
+        return await self._ainvoke_stage("writing", {"draft_guidelines": "\n\n".join(drafts)})
+
+    async def _ainvoke_stage(self, stage, inputs):
+        """
+        Invokes the stage's chain, reusing the cached output if the same inputs were already processed.
+        The cache key covers the model and its parameters, the stage's prompt, and the inputs, so only
+        the stages whose prompt or inputs changed are recomputed.
+        """
+        key_inputs = [self.model, self.temperature, self.num_ctx, STAGE_PROMPTS[stage], inputs]
+        if stage == "writing":
+            key_inputs.append(self.max_output_tokens)
+        key = compute_text_hash(json.dumps(key_inputs, sort_keys=True, ensure_ascii=False))
+        output = self.stage_caches[stage].get(key)
+        if output is None:
+            output = await getattr(self, f"{stage}_chain").ainvoke(inputs)
+            self.stage_caches[stage].set(key, output)
+        return output
+
+    async def _draft_guidelines(self, snsb_scores, snsb_reports):
+        """
+        Runs Stage 1 and Stage 2 as a per-subject pipeline, so that each subject's draft guideline
+        is requested as soon as its role-play answer arrives.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def draft_guideline(snsb_score, snsb_report):
+            async with semaphore:
+                # Stage 1: Emulating Experts through Role-Playing
+                answer = await self._ainvoke_stage(
+                    "roleplaying", {"snsb_score": snsb_score, "snsb_report": snsb_report}
+                )
+                # Stage 2: Synthesizing Step-by-Step Diagnostic Guidelines
+                return await self._ainvoke_stage("drafting", {"answer": answer})
+
+        return await asyncio.gather(
+            *(
+                draft_guideline(snsb_score, snsb_report)
+                for snsb_score, snsb_report in zip(snsb_scores, snsb_reports)
+            )
         )
+
+    async def _consolidate_guidelines(self, drafts):
+        """
+        Consolidates the draft guidelines hierarchically. The drafts are merged in groups that fit
+        the context window, in parallel, and the merged guidelines are merged again until a single
+        guideline remains. A single group is the same as consolidating all drafts at once.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def merge(group):
+            # A group of one draft has nothing to merge
+            if len(group) == 1:
+                return group[0]
+            async with semaphore:
+                return await self._ainvoke_stage("writing", {"draft_guidelines": "\n\n".join(group)})
+
+        level = 0
+        while True:
+            groups = self._group_by_token_budget(drafts)
+            if len(groups) == 1:
+                return await self._ainvoke_stage("writing", {"draft_guidelines": "\n\n".join(groups[0])})
+            level += 1
+            print(f"Consolidating {len(drafts)} guidelines in {len(groups)} groups (level {level})...")
+            drafts = await asyncio.gather(*(merge(group) for group in groups))
+
+    def _group_by_token_budget(self, drafts):
+        """
+        Greedily groups consecutive drafts so that each group fits the consolidation prompt's token budget.
+        Each group holds at least two drafts (if available) so that every level reduces the number of drafts.
+        """
+        prompt_tokens = self._estimate_tokens(UNIFIED_GUIDELINE_PROMPT["system"] + UNIFIED_GUIDELINE_PROMPT["user"])
+        token_budget = self.num_ctx - prompt_tokens - self.max_output_tokens
         
-        # Save the generated guideline
-        self._save_guideline(diagnostic_guideline)
-        
-        return diagnostic_guideline
+        groups, group, group_tokens = [], [], 0
+        for draft in drafts:
+            draft_tokens = self._estimate_tokens(draft)
+            if len(group) >= 2 and group_tokens + draft_tokens > token_budget:
+                groups.append(group)
+                group, group_tokens = [], 0
+            group.append(draft)
+            group_tokens += draft_tokens
+        if group:
+            groups.append(group)
+        return groups
 
+    @staticmethod
+    def _estimate_tokens(text):
+        """
+        Conservatively estimates the number of tokens in the text (about 3 characters per token).
+        """
+        return len(text) // 3 + 1
 
-    def _initialize_llm(self, model, num_ctx):
+    def _initialize_llm(self, model, num_ctx, max_output_tokens=None):
         """
-        Initializes the appropriate language model based on the model.
+        Initializes the appropriate language model based on the model, optionally capping its output tokens.
         """
         if model.startswith("gpt"):
-            return ChatOpenAI(model=model, temperature=0.1)
-        return ChatOllama(model=model, temperature=0.1, num_ctx=num_ctx)
+            return ChatOpenAI(model=model, temperature=self.temperature, max_tokens=max_output_tokens)
+        return ChatOllama(model=model, temperature=self.temperature, num_ctx=num_ctx, num_predict=max_output_tokens)
     
-    def _get_chain(self, prompt_text):
+    def _get_chain(self, prompt_text, llm=None):
         """
-        Creates a chain using the given prompt text.
+        Creates a chain using the given prompt text (and the default language model unless one is given).
         """
         prompt_template = ChatPromptTemplate.from_messages(
             [
@@ -86,20 +207,44 @@ class DiagnosticGuidelineSynthesizer:
                 ("user", prompt_text['user'])
             ]
         )
-        return prompt_template | self.llm | StrOutputParser()
+        return prompt_template | (llm or self.llm) | StrOutputParser()
+    
+    def get_guideline_path(self, source_subject_ids):
+        """
+        Gets the path of the guideline for the given source subjects, whether or not it has been synthesized.
+        """
+        guideline_key, _ = self._get_guideline_key(source_subject_ids)
+        return os.path.join(self.guideline_dir, self.model, f"{guideline_key}.txt")
+    
+    def _get_guideline_key(self, source_subject_ids):
+        """
+        Gets the content address of the guideline, which covers the source subjects, the model and its
+        sampling parameters, the prompts of every stage, and the consolidation settings.
+        """
+        guideline_metadata = {
+            "source_subject_ids": sorted(source_subject_ids),
+            "model": self.model,
+            "temperature": self.temperature,
+            "num_ctx": self.num_ctx,
+            "consolidation": self.consolidation,
+            "max_output_tokens": self.max_output_tokens,
+            "prompts": STAGE_PROMPTS,
+        }
+        guideline_key = compute_text_hash(json.dumps(guideline_metadata, sort_keys=True, ensure_ascii=False))
+        return guideline_key, guideline_metadata
     
-    def _guideline_exists(self):
+    def _guideline_exists(self, save_path):
         """
         Checks if the guideline already exists.
         """
-        return os.path.exists(self.save_path)
+        return os.path.exists(save_path)
     
-    def _load_existing_guideline(self):
+    def _load_existing_guideline(self, save_path):
         """
         Loads the existing guideline from the file.
         """
-        print("Diagnostic guidelines have already been generated.")
-        with open(self.save_path, "r") as f:
+        print(f"Diagnostic guidelines have already been generated at '{save_path}'.")
+        with open(save_path, "r") as f:
             return f.read()
     
     def _load_snsb_data(self, subject_ids):
@@ -112,9 +257,12 @@ class DiagnosticGuidelineSynthesizer:
             reports.append(get_snsb_data_by_subject_id(subject_id, "report"))
         return scores, reports
     
-    def _save_guideline(self, guideline):
+    def _save_guideline(self, guideline, guideline_metadata, save_path):
         """
-        Saves the synthesized diagnostic guideline to a file.
+        Saves the synthesized diagnostic guideline to a file, along with the metadata it was synthesized from.
         """
-        with open(self.save_path, "w") as f:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        with open(os.path.splitext(save_path)[0] + ".json", "w") as f:
+            json.dump(guideline_metadata, f, ensure_ascii=False, indent=2)
+        with open(save_path, "w") as f:
             f.write(guideline)
\ No newline at end of file
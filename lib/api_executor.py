@@ -1,17 +1,199 @@
 import os
+import re
+import json
+import time
+import asyncio
 import jsonlines
 from tqdm import tqdm
-from openai import OpenAI
-from ollama import chat, ChatResponse
+from collections import defaultdict
+from openai import OpenAI, AsyncOpenAI
+from ollama import Client, AsyncClient, ChatResponse
+
+from lib.request_scheduler import RequestScheduler, Endpoint, EndpointPool
+from lib.utils import RecordStore, TextCache, compute_text_hash, resolve_messages, write_text_atomic
+
+
+class ResponseLog:
+    """
+    A crash-safe, append-only log of responses.
+    Completed responses are appended to the response file, keyed by subject ID, and failed requests
+    are kept in a separate retry queue. Writes are buffered and flushed (and fsynced) in batches, so
+    a crash loses at most the last unflushed batch, which is then fetched again on resume.
+    """
+    def __init__(self, response_path, flush_every=16, flush_interval=5.0):
+        self.response_path = response_path
+        self.failure_path = f"{response_path}.failed.jsonl"
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        self.completed = RecordStore(self._load_records(response_path))
+        # Failed requests, keyed by subject ID
+        self.failures = {f["subject_id"]: f for f in self._load_records(self.failure_path)}
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        os.makedirs(os.path.dirname(response_path) or ".", exist_ok=True)
+        self._file = open(response_path, "a", encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_pending_subject_ids(self, subject_ids):
+        """
+        Get the subject IDs without a completed response, starting with the retry queue.
+        """
+        pending_subject_ids = [s for s in subject_ids if s not in self.completed]
+        return sorted(pending_subject_ids, key=lambda s: s not in self.failures)
+
+    def get_responses(self, subject_ids):
+        """
+        Get the completed responses in the order of the given subject IDs.
+        """
+        return [self.completed[s] for s in subject_ids if s in self.completed]
+
+    def append(self, response):
+        """
+        Append a completed response to the log.
+        """
+        if response["subject_id"] in self.completed:
+            return
+        self.completed.add(response)
+        self._buffer.append(json.dumps(response, ensure_ascii=False) + "\n")
+        if len(self._buffer) >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def append_failure(self, subject_id, error):
+        """
+        Add a failed request to the retry queue.
+        """
+        print(f"Error during fetching response for subject {subject_id}: {error}")
+        self.failures[subject_id] = {"subject_id": subject_id, "error": str(error)}
+
+    def flush(self):
+        """
+        Write the buffered responses to the file and fsync it.
+        """
+        if self._buffer:
+            self._file.write("".join(self._buffer))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Flush the remaining responses and save the retry queue.
+        """
+        self.flush()
+        self._file.close()
+        failures = [f for f in self.failures.values() if f["subject_id"] not in self.completed]
+        if failures:
+            write_text_atomic(self.failure_path, "".join(json.dumps(f, ensure_ascii=False) + "\n" for f in failures))
+            print(f"{len(failures)} requests failed. Re-run to retry them.")
+        elif os.path.exists(self.failure_path):
+            os.remove(self.failure_path)
+
+    @staticmethod
+    def _load_records(file_path):
+        """
+        Load the records from a JSON Lines file, truncating a partly written last line left by a crash.
+        Malformed lines before it are skipped, and their subjects are fetched again.
+        """
+        records = []
+        if not os.path.exists(file_path):
+            return records
+        with open(file_path, "rb") as f:
+            valid_size = 0
+            for line in f:
+                # Only the last line can be unterminated
+                if not line.endswith(b"\n"):
+                    break
+                valid_size += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Skipping a malformed record in '{file_path}'.")
+                    continue
+                # Failed responses of the previous log format are empty and are retried
+                if record:
+                    records.append(record)
+        if valid_size < os.path.getsize(file_path):
+            print(f"Truncating the partly written record at the end of '{file_path}'.")
+            with open(file_path, "r+b") as f:
+                f.truncate(valid_size)
+        return records
+
+
+class DiagnosisStreamParser:
+    """
+    Accumulates a streamed response and detects when the diagnosis label has been generated,
+    i.e., '### Diagnosis' followed by '(A)' or '(B)', outside of a reasoning model's '<think>' block.
+    The time to first token is measured from the parser's creation.
+    """
+    label_pattern = re.compile(r"### Diagnosis\s*\[?\s*\(([AB])\)")
+    lookback = 64
+
+    def __init__(self):
+        self.text = ""
+        self.done = False
+        self.ttft = None
+        self.diagnosis = None
+        self._start_time = time.monotonic()
+        self._search_start = 0
+
+    def feed(self, delta):
+        """
+        Add the next chunk of the response. Returns True once the diagnosis label is complete.
+        """
+        if not delta or self.done:
+            return self.done
+        if self.ttft is None:
+            self.ttft = time.monotonic() - self._start_time
+        self.text += delta
+
+        # Skip the reasoning, which may discuss the response format before answering
+        if self.text.lstrip().startswith("<think>"):
+            think_end = self.text.find("</think>")
+            if think_end < 0:
+                return False
+            self._search_start = max(self._search_start, think_end)
+        match = self.label_pattern.search(self.text, max(self._search_start, len(self.text) - len(delta) - self.lookback))
+        if match:
+            self.text = self.text[:match.end()]
+            self.diagnosis = f"({match.group(1)})"
+            self.done = True
+        return self.done
+
+    @classmethod
+    def extract_diagnosis(cls, text):
+        """
+        Extract the diagnosis from a complete response as from a streamed one: the label if there is one,
+        otherwise the text after '### Diagnosis', skipping the reasoning in both cases.
+        """
+        parser = cls()
+        parser.feed(text)
+        if parser.diagnosis is not None:
+            return parser.diagnosis
+        return text[parser._search_start:].split("### Diagnosis")[1].strip()
 
 
 class AbstractAPIExecutor:
     """
     An abstract class for API executors.
     """
-    def __init__(self, model, api_key):
+    default_concurrency = 1
+
+    def __init__(self, model, api_key, concurrency=None, base_urls=None, response_cache_dir="results/cache/responses"):
         self.model = model
         self.api_key = api_key
+        # Each endpoint takes up to `concurrency` requests, so throughput scales with the number of servers
+        self.base_urls = base_urls or [None]
+        self.concurrency = (concurrency or self.default_concurrency) * len(self.base_urls)
+        self.response_cache = TextCache(response_cache_dir)
+        # Retries transient errors and keeps up to `concurrency` requests in flight, backing off on rate limiting or overload
+        self.scheduler = RequestScheduler(max_concurrency=self.concurrency)
     
     def fetch_response(self, **kwargs):
         """
@@ -19,160 +201,665 @@ class AbstractAPIExecutor:
         """
         raise NotImplementedError("Subclasses must implement this method.")
     
-    def save_response(self, response, response_path):
+    def open_response_log(self, response_path, test_subject_ids):
         """
-        Save the response to a JSON Lines file.
+        Open the response log at the specified file path and report the cached responses.
         """
-        os.makedirs(os.path.dirname(response_path), exist_ok=True)
-        with jsonlines.open(response_path, mode="a") as writer:
-            writer.write(response)
-    
-    def load_cached_response(self, response_path):
+        print("Checking for cached responses...")
+        response_log = ResponseLog(response_path)
+        print(f"- Num of testset: {len(test_subject_ids)}")
+        print(f"- Num of responses: {len(response_log.completed)}")
+        if response_log.failures:
+            print(f"- Num of failed requests to retry: {len(response_log.failures)}")
+        return response_log
+
+    def get_sampling_options(self, payload):
         """
-        Load the cached responses from the specified file path.
+        Get the sampling options of the request for the payload.
         """
-        print("Checking for cached responses...")
-        if os.path.exists(response_path):
-            print(f"Responses already exist at '{response_path}'.")
-            with jsonlines.open(response_path, mode="r") as reader:
-                return list(reader)
-        print("No cached responses found.")
-        return []
+        sampling_options = {"temperature": payload["temperature"]}
+        # A seeded payload is one of several samples for the same messages
+        if payload.get("seed") is not None:
+            sampling_options["seed"] = payload["seed"]
+        return sampling_options
+
+    def load_response_from_cache(self, payload):
+        """
+        Load the response for an identical request (same model, messages, and sampling options)
+        from the content-addressed response cache, which is shared across runs and test types.
+        Cached responses are marked, as they have no request metrics (e.g., ttft).
+        """
+        generated_response = self.response_cache.get(self._get_response_cache_key(payload))
+        if generated_response is None:
+            return None
+        return self.build_response(payload, generated_response, cached=True)
+
+    def save_response_to_cache(self, payload, response):
+        """
+        Save the response to the content-addressed response cache.
+        """
+        self.response_cache.set(self._get_response_cache_key(payload), response["generated_response"])
+
+    def _get_response_cache_key(self, payload):
+        return compute_text_hash(json.dumps(
+            [self.model, resolve_messages(payload), self.get_sampling_options(payload)],
+            sort_keys=True, ensure_ascii=False,
+        ))
 
 
 class APIExecutor(AbstractAPIExecutor):
-    def __init__(self, model, api_key):
-        super().__init__(model, api_key)
+    def __init__(self, model, api_key, concurrency=None, base_urls=None):
+        super().__init__(model, api_key, concurrency, base_urls)
 
-    def process_responses(self, input_payloads, test_subject_ids, response_path, fetch_method):
+    def process_responses(self, input_payloads, test_subject_ids, response_path, fetch_method, async_fetch_method=None,
+                          on_response=None):
         """
         Processes responses by either loading cached responses or fetching new ones.
         Args:
-            input_payloads (list): List of payloads to be sent to the API.
+            input_payloads (iterable): Payloads to be sent to the API. A generator is consumed lazily,
+                so requests go out while the remaining payloads are still being created.
             test_subject_ids (list): List of test subject IDs.
             response_path (str): Path to the cached responses.
             fetch_method (callable): Method to fetch responses from the API.
+            async_fetch_method (callable, optional): Coroutine function to fetch responses concurrently.
+                Used when the executor's concurrency is greater than 1.
+            on_response (callable, optional): Called with each payload and its response as it completes
+                (or is found in the cached responses), e.g., to update the metrics incrementally.
         Returns:
             list: List of responses.
         """
         # ---------------------------------------------------------------------
         # Check to cached response
         # ---------------------------------------------------------------------
-        response_list = self.load_cached_response(response_path)
-        num_responses = len(response_list)
+        with self.open_response_log(response_path, test_subject_ids) as response_log:
+            num_pending = len(response_log.get_pending_subject_ids(test_subject_ids))
+            if num_pending == 0:
+                print("Successfully loaded the cached responses!")
+                return response_log.get_responses(test_subject_ids)
+            elif response_log.completed:
+                print(f"Continuing from {len(response_log.completed)} cached responses...")
 
-        print(f"- Num of testset: {len(test_subject_ids)}")
-        print(f"- Num of responses: {num_responses}")
+            # -----------------------------------------------------------------
+            # Execute the API
+            # -----------------------------------------------------------------
+            pending_payloads = self._iter_pending_payloads(input_payloads, test_subject_ids, response_log, on_response)
+            if self.concurrency > 1 and async_fetch_method is not None:
+                asyncio.run(self._process_responses_async(
+                    pending_payloads, num_pending, async_fetch_method, response_log, on_response
+                ))
+            else:
+                for payload in tqdm(pending_payloads, total=num_pending, desc="Fetching responses"):
+                    try:
+                        response = self.load_response_from_cache(payload)
+                        if response is None:
+                            response = self.scheduler.call(fetch_method, payload)
+                            self.save_response_to_cache(payload, response)
+                        self._record_response(payload, response, response_log, on_response)
+                    except Exception as e:
+                        response_log.append_failure(payload["subject_id"], e)
+            return response_log.get_responses(test_subject_ids)
+
+    async def _process_responses_async(self, pending_payloads, num_pending, async_fetch_method, response_log, on_response):
+        """
+        Fetches the responses concurrently, keeping as many requests in flight as the scheduler allows
+        (at most `self.concurrency`). Each response is logged as soon as it completes.
+        """
+        progress_bar = tqdm(total=num_pending, desc=f"Fetching responses (concurrency={self.concurrency})")
 
-        if num_responses == len(test_subject_ids):
-            print("Successfully loaded the cached responses!")
-            return response_list
-        elif num_responses > 0:
-            print(f"Continuing from {num_responses} cached responses...")
+        # Identical requests wait for the first one and then reuse its cached response
+        request_locks = defaultdict(asyncio.Lock)
 
-        # ---------------------------------------------------------------------
-        # Execute the API
-        # ---------------------------------------------------------------------
-        for test_subject_id in tqdm(
-            test_subject_ids[num_responses:], desc="Fetching responses"
-        ):
-            payload = next(p for p in input_payloads if p["subject_id"] == test_subject_id)
-            response = fetch_method(payload)
-            response_list.append(response)
-            self.save_response(response, response_path)
-        return response_list
+        # Only a window of payloads is taken from the (possibly lazy) payloads ahead of the requests in flight
+        window = asyncio.Semaphore(2 * self.concurrency)
+
+        async def fetch(payload):
+            try:
+                async with request_locks[self._get_response_cache_key(payload)]:
+                    response = self.load_response_from_cache(payload)
+                    if response is None:
+                        response = await self.scheduler.acall(async_fetch_method, payload)
+                        self.save_response_to_cache(payload, response)
+                self._record_response(payload, response, response_log, on_response)
+            except Exception as e:
+                response_log.append_failure(payload["subject_id"], e)
+            finally:
+                window.release()
+            progress_bar.set_postfix(in_flight_limit=self.scheduler.concurrency)
+            progress_bar.update(1)
+
+        tasks = []
+        for payload in pending_payloads:
+            await window.acquire()
+            tasks.append(asyncio.create_task(fetch(payload)))
+        await asyncio.gather(*tasks)
+        progress_bar.close()
+
+    def _iter_pending_payloads(self, input_payloads, test_subject_ids, response_log, on_response):
+        """
+        Yields the payloads of the test subjects without a completed response, starting with the retry queue.
+        The other payloads are held back only until the last failed subject's payload has been read.
+        """
+        test_subject_ids = set(test_subject_ids)
+        num_failures = sum(1 for s in response_log.failures if s in test_subject_ids and s not in response_log.completed)
+        held_back = []
+        for payload in input_payloads:
+            subject_id = payload["subject_id"]
+            if subject_id not in test_subject_ids:
+                continue
+            if subject_id in response_log.completed:
+                if on_response is not None:
+                    on_response(payload, response_log.completed[subject_id])
+                continue
+            if num_failures == 0:
+                yield payload
+            elif subject_id in response_log.failures:
+                num_failures -= 1
+                yield payload
+                if num_failures == 0:
+                    yield from held_back
+                    held_back = []
+            else:
+                held_back.append(payload)
+        yield from held_back
+
+    def _record_response(self, payload, response, response_log, on_response):
+        if payload["subject_id"] in response_log.completed:
+            return
+        response_log.append(response)
+        if on_response is not None:
+            on_response(payload, response)
+
+    def build_response(self, payload, response, diagnosis=None, **metrics):
+        """
+        Build the response record from the generated text, along with any request metrics (e.g., ttft).
+        Streamed, fetched, and cached responses share the same diagnosis extraction.
+        """
+        return {
+            "subject_id": payload["subject_id"],
+            "diagnosis": diagnosis or DiagnosisStreamParser.extract_diagnosis(response),
+            "generated_response": response,
+            **metrics,
+        }
+
+    def build_streamed_response(self, payload, parser):
+        """
+        Build the response record from a streamed response.
+        """
+        return self.build_response(
+            payload, parser.text, parser.diagnosis, ttft=round(parser.ttft or 0.0, 4), early_stopped=parser.done
+        )
     
 
 class OpenaiAPIExecutor(APIExecutor):
     """
     A class to execute the OpenAI API.
     """
-    def __init__(self, model, api_key):
-        super().__init__(model, api_key, 0)
-        self.client = OpenAI(api_key=api_key)
+    batch_poll_interval = 30
+
+    def __init__(self, model, api_key, concurrency=None, base_urls=None):
+        super().__init__(model, api_key, concurrency, base_urls)
+        # Retries are handled by the request scheduler
+        self.endpoints = EndpointPool([
+            Endpoint(
+                base_url,
+                OpenAI(api_key=self.api_key, base_url=base_url, max_retries=0),
+                AsyncOpenAI(api_key=self.api_key, base_url=base_url, max_retries=0),
+            )
+            for base_url in self.base_urls
+        ])
+        # Batch jobs are submitted to the first endpoint
+        self.client = self.endpoints.primary.client
     
     def fetch_response(self, **kwargs):
+        if kwargs.get('batch'):
+            return self.process_batch_responses(
+                kwargs['input_payloads'], kwargs['test_subject_ids'], kwargs['response_path']
+            )
+        if kwargs.get('stream'):
+            return self.process_responses(
+                kwargs['input_payloads'], kwargs['test_subject_ids'], kwargs['response_path'],
+                lambda payload: self._stream_openai_response(payload),
+                lambda payload: self._astream_openai_response(payload),
+                kwargs.get('on_response'),
+            )
         return self.process_responses(
             kwargs['input_payloads'], kwargs['test_subject_ids'], kwargs['response_path'],
-            lambda payload: self._fetch_openai_response(payload)
+            lambda payload: self._fetch_openai_response(payload),
+            lambda payload: self._afetch_openai_response(payload),
+            kwargs.get('on_response'),
         )
+
+    def process_batch_responses(self, input_payloads, test_subject_ids, response_path):
+        """
+        Processes responses through the Batch API by submitting all pending payloads as one job.
+        The job's state is saved next to the responses, so an interrupted run resumes polling
+        the same job instead of submitting a new one.
+        Args:
+            input_payloads (list): List of payloads to be sent to the API.
+            test_subject_ids (list): List of test subject IDs.
+            response_path (str): Path to the cached responses.
+        Returns:
+            list: List of responses.
+        """
+        # ---------------------------------------------------------------------
+        # Check to cached response
+        # ---------------------------------------------------------------------
+        with self.open_response_log(response_path, test_subject_ids) as response_log:
+            pending_subject_ids = response_log.get_pending_subject_ids(test_subject_ids)
+            if not pending_subject_ids:
+                print("Successfully loaded the cached responses!")
+                return response_log.get_responses(test_subject_ids)
+
+            # -----------------------------------------------------------------
+            # Submit the batch job (or resume the submitted one)
+            # -----------------------------------------------------------------
+            payload_store = RecordStore(input_payloads)
+            batch_state_path = f"{response_path}.batch.json"
+            batch_state = self._load_batch_state(batch_state_path)
+            if batch_state is None:
+                # Reuse the responses of identical requests instead of submitting them
+                for subject_id in pending_subject_ids:
+                    response = self.load_response_from_cache(payload_store[subject_id])
+                    if response is not None:
+                        response_log.append(response)
+                pending_subject_ids = response_log.get_pending_subject_ids(pending_subject_ids)
+                if not pending_subject_ids:
+                    print("Loaded all pending responses from the response cache!")
+                    return response_log.get_responses(test_subject_ids)
+                
+                batch_input_path = f"{response_path}.batch_input.jsonl"
+                self._write_batch_input(payload_store, pending_subject_ids, batch_input_path)
+                batch_input_file = self.scheduler.call(self._upload_batch_input, batch_input_path)
+                batch = self.scheduler.call(
+                    self.client.batches.create,
+                    input_file_id=batch_input_file.id,
+                    endpoint="/v1/chat/completions",
+                    completion_window="24h",
+                )
+                batch_state = {"batch_id": batch.id, "input_file_id": batch_input_file.id, "status": batch.status}
+                self._save_batch_state(batch_state, batch_state_path)
+                print(f"Submitted batch job '{batch.id}' with {len(pending_subject_ids)} requests.")
+            else:
+                print(f"Resuming batch job '{batch_state['batch_id']}'...")
+
+            # -----------------------------------------------------------------
+            # Poll the batch job until it finishes
+            # -----------------------------------------------------------------
+            while True:
+                batch = self.scheduler.call(self.client.batches.retrieve, batch_state["batch_id"])
+                batch_state["status"] = batch.status
+                self._save_batch_state(batch_state, batch_state_path)
+                if batch.status in ("completed", "failed", "expired", "cancelled"):
+                    break
+                if batch.request_counts is not None:
+                    print(f"Batch status: {batch.status} ({batch.request_counts.completed}/{batch.request_counts.total})")
+                time.sleep(self.batch_poll_interval)
+
+            # -----------------------------------------------------------------
+            # Stream the results into the cached responses
+            # -----------------------------------------------------------------
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id is None:
+                    continue
+                with self.client.files.with_streaming_response.content(file_id) as content:
+                    for line in content.iter_lines():
+                        if not line.strip():
+                            continue
+                        result = json.loads(line)
+                        if result["custom_id"] in response_log.completed:
+                            continue
+                        payload = payload_store[result["custom_id"]]
+                        try:
+                            response = self._parse_batch_result(payload, result)
+                            self.save_response_to_cache(payload, response)
+                            response_log.append(response)
+                        except Exception as e:
+                            response_log.append_failure(result["custom_id"], e)
+
+            if batch.status != "completed":
+                print(f"Batch job '{batch.id}' ended with status '{batch.status}'. Re-run to submit the remaining requests.")
+            os.remove(batch_state_path)
+            if os.path.exists(f"{response_path}.batch_input.jsonl"):
+                os.remove(f"{response_path}.batch_input.jsonl")
+            return response_log.get_responses(test_subject_ids)
+
+    def _write_batch_input(self, payload_store, subject_ids, batch_input_path):
+        """
+        Write the batch input file with one chat completion request per subject.
+        """
+        os.makedirs(os.path.dirname(batch_input_path), exist_ok=True)
+        with jsonlines.open(batch_input_path, mode="w") as writer:
+            for subject_id in subject_ids:
+                payload = payload_store[subject_id]
+                writer.write({
+                    "custom_id": subject_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": self.model,
+                        "messages": resolve_messages(payload),
+                        **self.get_sampling_options(payload),
+                    },
+                })
+
+    def _upload_batch_input(self, batch_input_path):
+        with open(batch_input_path, "rb") as f:
+            return self.client.files.create(file=f, purpose="batch")
+
+    def _parse_batch_result(self, payload, result):
+        """
+        Build the response from a batch result, raising the request's error if it failed.
+        """
+        if result.get("error"):
+            raise RuntimeError(result["error"])
+        status_code, body = result["response"]["status_code"], result["response"]["body"]
+        if status_code != 200:
+            raise RuntimeError(f"Request failed with status {status_code}: {body.get('error', body)}")
+        return self.build_response(payload, body["choices"][0]["message"]["content"])
+
+    @staticmethod
+    def _load_batch_state(batch_state_path):
+        """
+        Load the state of a previously submitted batch job, if any.
+        """
+        if os.path.exists(batch_state_path):
+            with open(batch_state_path, "r") as f:
+                return json.load(f)
+        return None
+
+    @staticmethod
+    def _save_batch_state(batch_state, batch_state_path):
+        """
+        Save the state of the batch job.
+        """
+        os.makedirs(os.path.dirname(batch_state_path), exist_ok=True)
+        with open(batch_state_path, "w") as f:
+            json.dump(batch_state, f)
         
     def _fetch_openai_response(self, payload):
-        try:
-            completion = self.client.chat.completions.create(
+        with self.endpoints.use() as endpoint:
+            completion = endpoint.client.chat.completions.create(
                 model=self.model,
-                messages=payload["messages"],
-                temperature=payload["temperature"]
+                messages=resolve_messages(payload),
+                **self.get_sampling_options(payload)
             )
-            response = completion.choices[0].message.content
-            return {
-                "subject_id": payload["subject_id"],
-                "diagnosis": response.split("### Diagnosis")[1].strip(),
-                "generated_response": response,
-            }
-        except Exception as e:
-            print(f"Error during fetching response: {e}")
-            return {}
+        return self.build_response(payload, completion.choices[0].message.content)
+
+    async def _afetch_openai_response(self, payload):
+        with self.endpoints.use() as endpoint:
+            completion = await endpoint.async_client.chat.completions.create(
+                model=self.model,
+                messages=resolve_messages(payload),
+                **self.get_sampling_options(payload)
+            )
+        return self.build_response(payload, completion.choices[0].message.content)
+
+    def _stream_openai_response(self, payload):
+        parser = DiagnosisStreamParser()
+        with self.endpoints.use() as endpoint:
+            stream = endpoint.client.chat.completions.create(
+                model=self.model,
+                messages=resolve_messages(payload),
+                **self.get_sampling_options(payload),
+                stream=True,
+            )
+            # Closing the stream aborts the generation on the server
+            with stream:
+                for chunk in stream:
+                    if chunk.choices and parser.feed(chunk.choices[0].delta.content):
+                        break
+        return self.build_streamed_response(payload, parser)
+
+    async def _astream_openai_response(self, payload):
+        parser = DiagnosisStreamParser()
+        with self.endpoints.use() as endpoint:
+            stream = await endpoint.async_client.chat.completions.create(
+                model=self.model,
+                messages=resolve_messages(payload),
+                **self.get_sampling_options(payload),
+                stream=True,
+            )
+            async with stream:
+                async for chunk in stream:
+                    if chunk.choices and parser.feed(chunk.choices[0].delta.content):
+                        break
+        return self.build_streamed_response(payload, parser)
     
 
 class OllamaAPIExecutor(APIExecutor):
     """
     A class to execute the Ollama API.
     """
-    def __init__(self, model, api_key):
-        super().__init__(model, api_key)
-        # self.client = OpenAI(
-        #     base_url="http://localhost:11434/v1",
-        #     api_key=self.api_key,
-        # )
+    def __init__(self, model, api_key, concurrency=None, base_urls=None):
+        super().__init__(model, api_key, concurrency, base_urls)
+        self.endpoints = EndpointPool([
+            Endpoint(base_url, Client(host=base_url), AsyncClient(host=base_url))
+            for base_url in self.base_urls
+        ])
         
     def fetch_response(self, **kwargs):
+        if kwargs.get('batch'):
+            raise ValueError("Batch mode is not supported by the Ollama API.")
+        if kwargs.get('stream'):
+            return self.process_responses(
+                kwargs['input_payloads'], kwargs['test_subject_ids'], kwargs['response_path'],
+                lambda payload: self._stream_ollama_response(payload),
+                lambda payload: self._astream_ollama_response(payload),
+                kwargs.get('on_response'),
+            )
         return self.process_responses(
             kwargs['input_payloads'], kwargs['test_subject_ids'], kwargs['response_path'],
-            lambda payload: self._fetch_ollama_response(payload)
+            lambda payload: self._fetch_ollama_response(payload),
+            lambda payload: self._afetch_ollama_response(payload),
+            kwargs.get('on_response'),
         )
 
+    def get_sampling_options(self, payload):
+        return {**super().get_sampling_options(payload), "num_ctx": 8192}
+
     def _fetch_ollama_response(self, payload):
-        try:
-            completion: ChatResponse = chat(
+        with self.endpoints.use() as endpoint:
+            completion: ChatResponse = endpoint.client.chat(
                 model=self.model,
-                messages=payload["messages"],
-                options={"temperature": payload["temperature"], "num_ctx": 8192}
+                messages=resolve_messages(payload),
+                options=self.get_sampling_options(payload)
             )
-            response = completion.message.content
-            return {
-                "subject_id": payload["subject_id"],
-                "diagnosis": response.split("### Diagnosis")[1].strip(),
-                "generated_response": response,
-            }
-        except Exception as e:
-            print(f"Error during fetching response: {e}")
-            return {}
+        return self.build_response(payload, completion.message.content)
+
+    async def _afetch_ollama_response(self, payload):
+        with self.endpoints.use() as endpoint:
+            completion: ChatResponse = await endpoint.async_client.chat(
+                model=self.model,
+                messages=resolve_messages(payload),
+                options=self.get_sampling_options(payload)
+            )
+        return self.build_response(payload, completion.message.content)
+
+    def _stream_ollama_response(self, payload):
+        parser = DiagnosisStreamParser()
+        with self.endpoints.use() as endpoint:
+            stream = endpoint.client.chat(
+                model=self.model,
+                messages=resolve_messages(payload),
+                options=self.get_sampling_options(payload),
+                stream=True,
+            )
+            # Closing the stream aborts the generation on the server
+            try:
+                for chunk in stream:
+                    if parser.feed(chunk.message.content):
+                        break
+            finally:
+                stream.close()
+        return self.build_streamed_response(payload, parser)
+
+    async def _astream_ollama_response(self, payload):
+        parser = DiagnosisStreamParser()
+        with self.endpoints.use() as endpoint:
+            stream = await endpoint.async_client.chat(
+                model=self.model,
+                messages=resolve_messages(payload),
+                options=self.get_sampling_options(payload),
+                stream=True,
+            )
+            try:
+                async for chunk in stream:
+                    if parser.feed(chunk.message.content):
+                        break
+            finally:
+                await stream.aclose()
+        return self.build_streamed_response(payload, parser)
     
 
-class VllmAPIExecutor(APIExecutor):
+class VllmAPIExecutor(OpenaiAPIExecutor):
     """
     A class to execute the vLLM API.
+    
+    vLLM serves an OpenAI-compatible API, so the requests are sent through the OpenAI clients.
+    Many requests are kept in flight by default so that vLLM's continuous batching can
+    schedule the whole test cohort together.
     """
-    def __init__(self, model, api_key):
-        super().__init__(model, api_key)
-        self.client = OpenAI(
-            base_url="http://localhost:8000/v1",
+    default_concurrency = 64
+
+    def __init__(self, model, api_key, concurrency=None, base_urls=None):
+        super().__init__(
+            model, api_key or "EMPTY", concurrency, base_urls or ["http://localhost:8000/v1"]
         )
 
-    
+    def fetch_response(self, **kwargs):
+        # vLLM's OpenAI-compatible server has no Files or Batch API
+        if kwargs.get('batch'):
+            raise ValueError("Batch mode is not supported by the vLLM API.")
+        return super().fetch_response(**kwargs)
+
+
+class CascadeAPIExecutor:
+    """
+    A class to execute a model cascade: every payload goes to a cheap model first, and only the subjects
+    it is uncertain about are escalated to a large model.
+
+    The cheap model's confidence is measured by self-consistency: it answers `num_samples` seeded samples
+    of each payload at `sample_temperature`, and the confidence is the share of samples agreeing with the
+    majority label. Subjects with a confidence below `threshold` (or without a majority) are escalated.
+    The samples are kept in `{response_path}.samples.jsonl` and the large model's responses in
+    `{response_path}.escalated.jsonl`; both executors' response caches are shared with the single-model runs.
+    """
+    def __init__(self, small_executor, large_executor, num_samples=3, sample_temperature=0.7, threshold=1.0):
+        self.small_executor = small_executor
+        self.large_executor = large_executor
+        self.num_samples = num_samples
+        self.sample_temperature = sample_temperature
+        self.threshold = threshold
+        self.sample_responses = []
+
+    def fetch_response(self, **kwargs):
+        if kwargs.get('batch'):
+            raise ValueError("Batch mode is not supported by the cascade.")
+        return self.process_cascade_responses(
+            kwargs['input_payloads'], kwargs['test_subject_ids'], kwargs['response_path'], kwargs.get('stream', False),
+            kwargs.get('on_response'),
+        )
+
+    def process_cascade_responses(self, input_payloads, test_subject_ids, response_path, stream=False, on_response=None):
+        """
+        Processes responses through the cascade.
+        Args:
+            input_payloads (iterable): Payloads to be sent to the API.
+            test_subject_ids (list): List of test subject IDs.
+            response_path (str): Path to the cascade's responses.
+            stream (bool, optional): Whether to stream the responses with early stopping.
+            on_response (callable, optional): Called with each payload and its final response, once the cheap model's
+                confident responses are known and then as the escalated responses complete.
+        Returns:
+            list: List of responses, each with the model that answered it and the cheap model's confidence.
+        """
+        payload_store = RecordStore(input_payloads)
+        test_subject_ids = [s for s in test_subject_ids if s in payload_store]
+
+        # ---------------------------------------------------------------------
+        # Sample the cheap model
+        # ---------------------------------------------------------------------
+        print(f"Sampling {self.num_samples} responses per subject from '{self.small_executor.model}'...")
+        sample_payloads = [
+            {**payload_store[subject_id], "subject_id": f"{subject_id}#{i}", "temperature": self.sample_temperature, "seed": i}
+            for subject_id in test_subject_ids for i in range(self.num_samples)
+        ]
+        self.sample_responses = self.small_executor.fetch_response(
+            input_payloads=sample_payloads,
+            test_subject_ids=[payload["subject_id"] for payload in sample_payloads],
+            response_path=f"{response_path}.samples.jsonl",
+            stream=stream,
+        )
+        sample_store = RecordStore(self.sample_responses)
+
+        # ---------------------------------------------------------------------
+        # Measure the confidence and escalate the uncertain subjects
+        # ---------------------------------------------------------------------
+        cascade_responses, escalated_subject_ids, confidences = {}, [], {}
+        for subject_id in test_subject_ids:
+            samples = [sample_store.get(f"{subject_id}#{i}") for i in range(self.num_samples)]
+            labels = [self.get_label(sample) for sample in samples]
+            votes = {label: labels.count(label) for label in ("(A)", "(B)")}
+            majority_label = max(votes, key=votes.get)
+            confidence = votes[majority_label] / self.num_samples
+            confidences[subject_id] = confidence
+            if confidence < self.threshold or votes["(A)"] == votes["(B)"]:
+                escalated_subject_ids.append(subject_id)
+                continue
+            sample = next(sample for sample, label in zip(samples, labels) if label == majority_label)
+            cascade_responses[subject_id] = {
+                **sample, "subject_id": subject_id, "cascade_model": self.small_executor.model, "confidence": confidence,
+            }
+            if on_response is not None:
+                on_response(payload_store[subject_id], cascade_responses[subject_id])
+        print(f"Escalating {len(escalated_subject_ids)} of {len(test_subject_ids)} subjects to '{self.large_executor.model}'...")
+
+        # ---------------------------------------------------------------------
+        # Fetch the large model's responses for the escalated subjects
+        # ---------------------------------------------------------------------
+        if escalated_subject_ids:
+            for response in self.large_executor.fetch_response(
+                input_payloads=[payload_store[subject_id] for subject_id in escalated_subject_ids],
+                test_subject_ids=escalated_subject_ids,
+                response_path=f"{response_path}.escalated.jsonl",
+                stream=stream,
+                on_response=on_response,
+            ):
+                cascade_responses[response["subject_id"]] = {
+                    **response, "cascade_model": self.large_executor.model, "confidence": confidences[response["subject_id"]],
+                }
+
+        response_list = [cascade_responses[s] for s in test_subject_ids if s in cascade_responses]
+        os.makedirs(os.path.dirname(response_path) or ".", exist_ok=True)
+        write_text_atomic(response_path, "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in response_list))
+        return response_list
+
+    @staticmethod
+    def get_label(response):
+        """
+        Get the diagnosis label of a response, or None if it failed or has no label.
+        """
+        if not response:
+            return None
+        if "(B)" in response["diagnosis"]:
+            return "(B)"
+        if "(A)" in response["diagnosis"]:
+            return "(A)"
+        return None
+
+
 class APIExecutorFactory:
     """
     A factory class to specify API executor based on the API type.
     """
     @staticmethod
-    def get_api_executor(model, api_type, api_key):
+    def get_api_executor(model, api_type, api_key, concurrency=None, base_urls=None):
         if api_type == 'openai':
-            return OpenaiAPIExecutor(model, api_key)
+            return OpenaiAPIExecutor(model, api_key, concurrency, base_urls)
         elif api_type == 'ollama':
-            return OllamaAPIExecutor(model, api_key)
+            return OllamaAPIExecutor(model, api_key, concurrency, base_urls)
         elif api_type == 'vllm':
-            return VllmAPIExecutor(model, api_key)
+            return VllmAPIExecutor(model, api_key, concurrency, base_urls)
         else:
             raise ValueError(f"Unsupported API type: {api_type}.")
         
@@ -0,0 +1,110 @@
+import os
+import json
+import random
+
+import joblib
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from lib.utils import RecordStore, compute_text_hash, get_snsb_data_by_subject_id
+
+
+class FewShotExampleBank:
+    """
+    A bank of few-shot examples built once per run from the source subjects.
+    Each example's SNSB scores and report are read and split into the rationale and diagnosis once,
+    and the examples are indexed by group (0: HC, 1: MCI). The examples for a subject are sampled with
+    a generator seeded by the subject ID, so the same subject always gets the same examples.
+    """
+    def __init__(self, source_subject_ids, info_dataset, seed=42):
+        self.seed = seed
+        self.examples = {}
+        self.scores = {}
+        self.group_subject_ids = {0: [], 1: []}
+
+        info_store = RecordStore(info_dataset)
+        for source_subject_id in source_subject_ids:
+            snsb_scores = get_snsb_data_by_subject_id(source_subject_id, "score")
+            snsb_report = get_snsb_data_by_subject_id(source_subject_id, "report")
+            rationale, diagnosis = snsb_report.split("\n\n")[:2]
+            self.scores[source_subject_id] = snsb_scores
+            self.examples[source_subject_id] = (
+                f"### SNSB-C Result\n{snsb_scores}\n\n"
+                f"### Clinical Rationale\n{rationale}\n\n"
+                f"### Diagnosis\n{diagnosis}"
+            )
+            group = info_store[source_subject_id]["group"]
+            if group in self.group_subject_ids:
+                self.group_subject_ids[group].append(source_subject_id)
+
+    def sample(self, num_examples, subject_id):
+        """
+        Sample the example subject IDs for a subject: one example from any group for 1-shot,
+        otherwise half of the examples from each group in a random order.
+        """
+        rng = random.Random(f"{self.seed}:{subject_id}")
+        if num_examples == 1:
+            return rng.sample(list(self.examples), 1)
+        example_subject_ids = (
+            rng.sample(self.group_subject_ids[0], num_examples // 2)
+            + rng.sample(self.group_subject_ids[1], num_examples // 2)
+        )
+        rng.shuffle(example_subject_ids)
+        return example_subject_ids
+
+    def get_examples(self, num_examples, subject_id):
+        """
+        Get the formatted few-shot examples for a subject.
+        """
+        return self.format_examples(self.sample(num_examples, subject_id))
+
+    def format_examples(self, example_subject_ids):
+        """
+        Format the examples of the given subjects.
+        """
+        example_str = ""
+        for i, example_subject_id in enumerate(example_subject_ids):
+            example_str += f"Example {i+1}.\n{self.examples[example_subject_id]}\n\n"
+        return example_str
+
+
+class FewShotExampleRetriever:
+    """
+    Retrieves the source cases most similar to a subject as its few-shot examples.
+    The SNSB score documents of the source subjects are embedded with TF-IDF (on CPU), and the index is
+    persisted under the hash of the documents, so it is built once per source set. The subjects are
+    compared by the cosine similarity of their score documents.
+    """
+    def __init__(self, example_bank, index_dir="data/cache/fewshot_index"):
+        self.example_bank = example_bank
+        self.subject_ids = list(example_bank.scores)
+        index_key = compute_text_hash(json.dumps([[s, example_bank.scores[s]] for s in self.subject_ids]))
+        index_path = os.path.join(index_dir, f"{index_key}.joblib")
+
+        if os.path.exists(index_path):
+            self.vectorizer, self.index = joblib.load(index_path)
+        else:
+            # Keep numbers and signs as terms, as the scores carry most of the information
+            self.vectorizer = TfidfVectorizer(token_pattern=r"[^\s|]+", sublinear_tf=True)
+            self.index = self.vectorizer.fit_transform([example_bank.scores[s] for s in self.subject_ids])
+            os.makedirs(index_dir, exist_ok=True)
+            tmp_index_path = f"{index_path}.{os.getpid()}.tmp"
+            joblib.dump((self.vectorizer, self.index), tmp_index_path)
+            os.replace(tmp_index_path, index_path)
+
+    def sample(self, num_examples, subject_id):
+        """
+        Get the IDs of the `num_examples` most similar source subjects, excluding the subject itself.
+        The most similar example comes last, right before the subject's own data.
+        """
+        query = self.vectorizer.transform([get_snsb_data_by_subject_id(subject_id, "score")])
+        similarities = (self.index @ query.T).toarray().ravel()
+        ranking = [self.subject_ids[i] for i in np.argsort(-similarities, kind="stable")]
+        nearest_subject_ids = [s for s in ranking if s != subject_id][:num_examples]
+        return nearest_subject_ids[::-1]
+
+    def get_examples(self, num_examples, subject_id):
+        """
+        Get the formatted few-shot examples for a subject.
+        """
+        return self.example_bank.format_examples(self.sample(num_examples, subject_id))
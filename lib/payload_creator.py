@@ -3,7 +3,12 @@ import jsonlines
 from tqdm import tqdm
 
 from lib.CLONE.workflow import DiagnosticGuidelineSynthesizer
-from lib.utils import get_snsb_data_by_subject_id, get_examples_for_fewshot
+from lib.fewshot import FewShotExampleBank, FewShotExampleRetriever
+from lib.utils import get_snsb_data_by_subject_id, payload_block_store
+
+
+# Placeholder for the subject's context when splitting the rendered user prompt into shared blocks
+CONTEXT_SLOT = "\x00context\x00"
 
 
 class AbstractPayloadCreator:
@@ -56,7 +61,7 @@ class PayloadCreator(AbstractPayloadCreator):
     def __init__(self, temperature, system_prompt_path, user_prompt_template_path):
         super().__init__(temperature, system_prompt_path, user_prompt_template_path)
 
-    def process_payloads(self, info_dataset, payload_path, test_subject_ids, context_generator):
+    def process_payloads(self, info_dataset, payload_path, test_subject_ids, context_generator, shared_context="", lazy=False):
         """
         Processes payloads by either loading cached payloads or creating new ones.
         Args:
@@ -64,9 +69,15 @@ class PayloadCreator(AbstractPayloadCreator):
             payload_path (str): Path to the cached payloads.
             test_subject_ids (set): Set of subject IDs to be marked as test subjects.
             context_generator (function): Function to generate context for each info data.
+            shared_context (str, optional): Context shared by all subjects (e.g., the diagnostic guideline),
+                placed before each subject's context.
+            lazy (bool, optional): Whether to return a generator that loads or creates each payload on demand.
         Returns:
-            list: List of processed payloads.
+            list: List of processed payloads (or a generator of them if lazy).
         """
+        if lazy:
+            return self.iter_payloads(info_dataset, payload_path, test_subject_ids, context_generator, shared_context)
+
         # ---------------------------------------------------------------------
         # Check to cached payloads
         # ---------------------------------------------------------------------
@@ -86,21 +97,57 @@ class PayloadCreator(AbstractPayloadCreator):
         # ---------------------------------------------------------------------
         # Create the payloads
         # ---------------------------------------------------------------------
-        for info_data in tqdm(info_dataset[num_cached:], desc="Creating payloads"):
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": self.prompt_template.format(context=context_generator(info_data))},
+        payload_list.extend(self._create_payloads(
+            tqdm(info_dataset[num_cached:], desc="Creating payloads"),
+            payload_path, test_subject_ids, context_generator, shared_context
+        ))
+        return payload_list
+
+    def iter_payloads(self, info_dataset, payload_path, test_subject_ids, context_generator, shared_context=""):
+        """
+        Yields the cached payloads as they are read, then creates (and caches) the remaining payloads one at a time,
+        so that the payloads can be consumed while they are being created.
+        """
+        num_cached = 0
+        if os.path.exists(payload_path):
+            with jsonlines.open(payload_path, mode="r") as reader:
+                for payload in reader:
+                    num_cached += 1
+                    yield payload
+        yield from self._create_payloads(
+            info_dataset[num_cached:], payload_path, test_subject_ids, context_generator, shared_context
+        )
+
+    def _create_payloads(self, info_dataset, payload_path, test_subject_ids, context_generator, shared_context):
+        """
+        Creates and caches the payloads for the given subjects one at a time.
+        """
+        # The parts of the messages shared by all subjects are stored once as blocks,
+        # and each payload keeps only references to them and its subject's context
+        system_block = payload_block_store.put(self.system_prompt)
+        user_prefix, user_suffix = self.render_user_prompt(shared_context, CONTEXT_SLOT).split(CONTEXT_SLOT)
+        user_prefix_block, user_suffix_block = payload_block_store.put(user_prefix), payload_block_store.put(user_suffix)
+
+        for info_data in info_dataset:
+            message_parts = [
+                {"role": "system", "parts": [{"block": system_block}]},
+                {"role": "user", "parts": [{"block": user_prefix_block}, context_generator(info_data), {"block": user_suffix_block}]},
             ]
             payload = {
                 "subject_id": info_data["subject_id"],
                 "ground_truth": info_data["group"],
                 "test": 1 if info_data["subject_id"] in test_subject_ids else 0,
-                "messages": messages,
+                "message_parts": message_parts,
                 "temperature": self.temperature,
             }
             self.save_payload(payload, payload_path)
-            payload_list.append(payload)
-        return payload_list
+            yield payload
+
+    def render_user_prompt(self, shared_context, context):
+        """
+        Render the user prompt from the shared and subject-specific contexts.
+        """
+        return self.prompt_template.format(context=shared_context + context)
 
 
 class ZeroShotPayloadCreator(PayloadCreator):
@@ -117,7 +164,8 @@ class ZeroShotPayloadCreator(PayloadCreator):
                 f"Education years: {info_data['education_years']}\n\n"
                 "### SNSB-C Result\n"
                 + get_snsb_data_by_subject_id(info_data['subject_id'], data_type="score")
-            )
+            ),
+            lazy=kwargs.get('lazy', False),
         )
             
     
@@ -126,18 +174,27 @@ class FewShotPayloadCreator(PayloadCreator):
     A class to create few-shot payloads for the API request.
     """
     def create_payload(self, **kwargs):
+        example_bank = FewShotExampleBank(kwargs['source_subject_ids'], kwargs['info_dataset'])
+        example_selection = kwargs.get('example_selection', 'random')
+        if example_selection == "random":
+            example_selector = example_bank
+        elif example_selection == "knn":
+            example_selector = FewShotExampleRetriever(example_bank)
+        else:
+            raise ValueError(f"Unsupported example selection: {example_selection}")
         return self.process_payloads(
             kwargs['info_dataset'], kwargs['payload_path'], kwargs['test_subject_ids'],
             lambda info_data: (
                 "### Examples\n"
-                + get_examples_for_fewshot(kwargs['num_examples'], kwargs['source_subject_ids']) + "\n\n"
+                + example_selector.get_examples(kwargs['num_examples'], info_data['subject_id']) + "\n\n"
                 f"### Subject information\n"
                 f"Age: {info_data['age']}\n"
                 f"Gender: {info_data['gender']}\n"
                 f"Education years: {info_data['education_years']}\n\n"
                 "### SNSB-C Result\n"
                 + get_snsb_data_by_subject_id(info_data['subject_id'], data_type="score")
-            )
+            ),
+            lazy=kwargs.get('lazy', False),
         )
 
 class CustomPayloadCreator(PayloadCreator):
@@ -145,23 +202,24 @@ class CustomPayloadCreator(PayloadCreator):
     A class to create custom payloads for the API request.
     """
     def create_payload(self, **kwargs):
-        # CLONE: Synthesize diagnostic guideline
-        diagnostic_guideline = DiagnosticGuidelineSynthesizer(
-            kwargs['model']
+        # CLONE: Synthesize diagnostic guideline, unless one is given
+        diagnostic_guideline = kwargs.get('diagnostic_guideline') or DiagnosticGuidelineSynthesizer(
+            kwargs['model'], max_concurrency=kwargs.get('concurrency')
         ).synthesize_diagonstic_guideline(
             kwargs['source_subject_ids']
         )
         return self.process_payloads(
             kwargs['info_dataset'], kwargs['payload_path'], kwargs['test_subject_ids'],
             lambda info_data: (
-                diagnostic_guideline + "\n\n"
                 f"### Subject information\n"
                 f"Age: {info_data['age']}\n"
                 f"Gender: {info_data['gender']}\n"
                 f"Education years: {info_data['education_years']}\n\n"
                 "### SNSB-C Result\n"
                 + get_snsb_data_by_subject_id(info_data['subject_id'], data_type="score")
-            )
+            ),
+            shared_context=diagnostic_guideline + "\n\n",
+            lazy=kwargs.get('lazy', False),
         )
     
 
@@ -0,0 +1,303 @@
+import time
+import random
+import asyncio
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+
+# -------------------------------------------------------------------------
+# Error classification
+# -------------------------------------------------------------------------
+RATE_LIMIT_STATUS_CODES = {429}
+OVERLOAD_STATUS_CODES = {408, 409, 500, 502, 503, 504}
+
+
+def get_status_code(error):
+    """
+    Get the HTTP status code of an API error (OpenAI, Ollama, or httpx), if any.
+    """
+    status_code = getattr(error, "status_code", None)
+    if status_code is None and isinstance(getattr(error, "response", None), httpx.Response):
+        status_code = error.response.status_code
+    return status_code
+
+
+def get_retry_after(error):
+    """
+    Get the delay in seconds requested by the server's Retry-After header, if any.
+    """
+    response = getattr(error, "response", None)
+    if not isinstance(response, httpx.Response):
+        return None
+    retry_after = response.headers.get("retry-after-ms")
+    if retry_after is not None:
+        try:
+            return float(retry_after) / 1000
+        except ValueError:
+            pass
+    retry_after = response.headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error):
+    """
+    Classify an API error as "rate_limit" (the server asked us to slow down), "overload"
+    (the server is unavailable or timed out), or "fatal" (retrying will not help).
+    """
+    status_code = get_status_code(error)
+    if status_code in RATE_LIMIT_STATUS_CODES:
+        return "rate_limit"
+    if status_code in OVERLOAD_STATUS_CODES or (status_code is not None and status_code >= 500):
+        return "overload"
+    if status_code is None and isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError)):
+        return "overload"
+    # The OpenAI client wraps transport errors into APIConnectionError/APITimeoutError
+    if status_code is None and isinstance(error.__cause__, (httpx.TransportError, ConnectionError, TimeoutError)):
+        return "overload"
+    if type(error).__name__ in ("APIConnectionError", "APITimeoutError"):
+        return "overload"
+    return "fatal"
+
+
+# -------------------------------------------------------------------------
+# Request scheduler
+# -------------------------------------------------------------------------
+class RequestScheduler:
+    """
+    Schedules the requests to an LLM backend.
+
+    Failed requests are retried with jittered exponential backoff, waiting at least as long as the
+    server's Retry-After header asks for. The number of in-flight requests follows an additive-increase,
+    multiplicative-decrease (AIMD) schedule: it starts at `initial_concurrency` (`max_concurrency` by
+    default), doubles per round trip until the first congestion signal (slow start), then grows by one
+    request per round trip, and is cut by `decrease_factor` on rate limiting, overload, or connection
+    errors. It never exceeds `max_concurrency`.
+
+    Backing off on latency is opt-in (`latency_tolerance`), as the latency of a batching server (e.g., vLLM)
+    is expected to rise with concurrency. When enabled, the limit is also cut when the smoothed latency
+    exceeds `latency_tolerance` times a baseline that tracks the lowest smoothed latency but decays
+    towards the current one by `baseline_decay` per request, so a few short responses do not pin it.
+    """
+    def __init__(self, max_concurrency=1, initial_concurrency=None, max_retries=5, base_delay=1.0, max_delay=60.0,
+                 decrease_factor=0.5, latency_tolerance=None, latency_smoothing=0.2, baseline_decay=0.01):
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = min(initial_concurrency or max_concurrency, max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.latency_smoothing = latency_smoothing
+        self.baseline_decay = baseline_decay
+        self.reset()
+
+    def reset(self):
+        """
+        Reset the concurrency limit and latency statistics.
+        """
+        self.limit = float(self.initial_concurrency)
+        self.in_flight = 0
+        self.slow_start = True
+        self.smoothed_latency = None
+        self.baseline_latency = None
+        self._last_decrease = 0.0
+        self._condition = None
+        self._loop = None
+
+    @property
+    def concurrency(self):
+        return max(1, min(self.max_concurrency, int(self.limit)))
+
+    def call(self, fetch_method, *args, **kwargs):
+        """
+        Call the fetch method, retrying transient errors with backoff.
+        """
+        for attempt in range(self.max_retries + 1):
+            start_time = time.monotonic()
+            try:
+                result = fetch_method(*args, **kwargs)
+            except Exception as e:
+                delay = self._on_error(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self._on_success(time.monotonic() - start_time)
+            return result
+
+    async def acall(self, async_fetch_method, *args, **kwargs):
+        """
+        Await the fetch coroutine once a slot is free under the current concurrency limit,
+        retrying transient errors with backoff. The slot is released while backing off.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self._acquire()
+            start_time = time.monotonic()
+            try:
+                result = await async_fetch_method(*args, **kwargs)
+            except Exception as e:
+                delay = self._on_error(e, attempt)
+                if delay is None:
+                    raise
+            else:
+                self._on_success(time.monotonic() - start_time)
+                return result
+            finally:
+                await self._release()
+            await asyncio.sleep(delay)
+
+    def get_backoff_delay(self, attempt, retry_after=None):
+        """
+        Get the delay before the next attempt: full-jitter exponential backoff, but never shorter
+        than the server's Retry-After.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    # ---------------------------------------------------------------------
+    # AIMD concurrency control
+    # ---------------------------------------------------------------------
+    def _on_success(self, latency):
+        self.smoothed_latency = latency if self.smoothed_latency is None else (
+            self.latency_smoothing * latency + (1 - self.latency_smoothing) * self.smoothed_latency
+        )
+        if self.baseline_latency is None or self.smoothed_latency < self.baseline_latency:
+            self.baseline_latency = self.smoothed_latency
+        else:
+            self.baseline_latency += self.baseline_decay * (self.smoothed_latency - self.baseline_latency)
+        if self.latency_tolerance is not None and self.smoothed_latency > self.latency_tolerance * self.baseline_latency:
+            self._decrease()
+        elif self.slow_start:
+            self.limit = min(self.max_concurrency, self.limit + 1)
+        else:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def _on_error(self, error, attempt):
+        """
+        Record a failed attempt and get the delay before retrying it, or None if it should not be retried.
+        """
+        error_type = classify_error(error)
+        if error_type == "fatal" or attempt >= self.max_retries:
+            return None
+        self._decrease()
+        delay = self.get_backoff_delay(attempt, get_retry_after(error))
+        print(f"Retrying in {delay:.1f}s after {error_type} error ({attempt + 1}/{self.max_retries}): {error}")
+        return delay
+
+    def _decrease(self):
+        # Requests in flight at the time of a congestion signal report the same congestion,
+        # so the limit is cut at most once per round trip
+        now = time.monotonic()
+        if now - self._last_decrease < (self.smoothed_latency or 0.0):
+            return
+        self._last_decrease = now
+        self.slow_start = False
+        self.limit = max(1.0, self.limit * self.decrease_factor)
+
+    async def _acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < self.concurrency)
+            self.in_flight += 1
+
+    async def _release(self):
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    def _get_condition(self):
+        # Each `asyncio.run` has its own event loop, so the condition is bound to the running loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._condition, self._loop = asyncio.Condition(), loop
+        return self._condition
+
+
+# -------------------------------------------------------------------------
+# Endpoint pool
+# -------------------------------------------------------------------------
+class Endpoint:
+    """
+    An inference server and its API clients.
+    """
+    def __init__(self, base_url, client, async_client):
+        self.base_url = base_url
+        self.client = client
+        self.async_client = async_client
+        self.outstanding = 0
+        self.failures = 0
+        self.down_until = 0.0
+
+    def is_up(self, now):
+        return self.down_until <= now
+
+
+class EndpointPool:
+    """
+    Dispatches requests across several inference servers serving the same model.
+    Each request goes to the endpoint with the fewest outstanding requests. An endpoint that fails
+    with `failure_threshold` consecutive overload or connection errors is taken out of rotation for
+    `cooldown` seconds, after which it gets requests again and returns to rotation on its first success.
+    """
+    def __init__(self, endpoints, failure_threshold=3, cooldown=30.0):
+        if not endpoints:
+            raise ValueError("At least one endpoint is required.")
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    @property
+    def primary(self):
+        return self.endpoints[0]
+
+    @contextmanager
+    def use(self):
+        """
+        Use the least loaded endpoint for a request, recording whether it succeeded.
+        """
+        endpoint = self._acquire()
+        try:
+            yield endpoint
+        except Exception as e:
+            self._release(endpoint, e)
+            raise
+        else:
+            self._release(endpoint)
+
+    def _acquire(self):
+        now = time.monotonic()
+        endpoints = [e for e in self.endpoints if e.is_up(now)]
+        if not endpoints:
+            # Every endpoint is down; probe the one that will recover first
+            endpoints = [min(self.endpoints, key=lambda e: e.down_until)]
+        endpoint = min(endpoints, key=lambda e: e.outstanding)
+        endpoint.outstanding += 1
+        return endpoint
+
+    def _release(self, endpoint, error=None):
+        endpoint.outstanding -= 1
+        if error is None or classify_error(error) != "overload":
+            endpoint.failures = 0
+            return
+        endpoint.failures += 1
+        if endpoint.failures >= self.failure_threshold:
+            endpoint.down_until = time.monotonic() + self.cooldown
+            if len(self.endpoints) > 1:
+                print(f"Taking endpoint '{endpoint.base_url}' out of rotation for {self.cooldown:.0f}s after {endpoint.failures} failures.")
@@ -3,12 +3,11 @@ import json
 import jsonlines
 from tqdm import tqdm
 
-from sklearn.metrics import confusion_matrix
 from prometheus_eval import PrometheusEval
 from prometheus_eval.vllm import VLLM
 from prometheus_eval.prompts import ABSOLUTE_PROMPT
 
-from lib.utils import load_jsonl, get_snsb_data_by_subject_id
+from lib.utils import load_jsonl, get_snsb_data_by_subject_id, resolve_messages, RecordStore
 from lib.rubrics import RATIONALE_RUBRICS
 
 
@@ -83,6 +82,47 @@ class ResponseEvaluator(AbstractResponseEvaluator):
         return eval_result
     
 
+class ClassificationMetrics:
+    """
+    A running confusion matrix of the diagnoses, updated one response at a time.
+    """
+    def __init__(self):
+        self.tp = self.tn = self.fp = self.fn = 0
+
+    @property
+    def total(self):
+        return self.tp + self.tn + self.fp + self.fn
+
+    def update(self, ground_truth, diagnosis):
+        """
+        Add a response's diagnosis ('(A)' or '(B)') against the ground truth (0: HC, 1: MCI).
+        """
+        prediction = 1 if "(B)" in diagnosis else 0
+        if prediction == 1:
+            if ground_truth == 1:
+                self.tp += 1
+            else:
+                self.fp += 1
+        elif ground_truth == 1:
+            self.fn += 1
+        else:
+            self.tn += 1
+
+    def compute(self):
+        """
+        Compute the evaluation metrics.
+        """
+        tp, tn, fp, fn = self.tp, self.tn, self.fp, self.fn
+        metrics = {
+            "accuracy": (tp + tn) / self.total if self.total > 0 else 0,
+            "precision": tp / (tp + fp) if (tp + fp) > 0 else 0,
+            "sensitivity": tp / (tp + fn) if (tp + fn) > 0 else 0,
+            "specificity": tn / (tn + fp) if (tn + fp) > 0 else 0,
+            "f1_score": (2 * tp / (2 * tp + fp + fn)) if (tp + fp + fn) > 0 else 0
+        }
+        return {"total_samples": self.total, **{k: round(v, 4) for k, v in metrics.items()}}
+
+
 class ClassificationResponseEvaluator(ResponseEvaluator):
     """
     A class to evaluate the classification responses.
@@ -94,23 +134,21 @@ class ClassificationResponseEvaluator(ResponseEvaluator):
         )
 
     def _evaluate_classification(self, input_payloads, response_list, test_subject_ids):
-        y_true, y_pred = [], []
+        # Only the ground truths are kept from the payloads, which may be streamed
+        test_subject_id_set = set(test_subject_ids)
+        ground_truths = {p["subject_id"]: p["ground_truth"] for p in input_payloads if p["subject_id"] in test_subject_id_set}
+        response_store = RecordStore(response_list)
+        metrics = ClassificationMetrics()
+        missing_subject_ids = [s for s in test_subject_ids if s not in response_store]
+        if missing_subject_ids:
+            print(f"Skipping {len(missing_subject_ids)} subjects without a response: {missing_subject_ids}")
         for test_subject_id in tqdm(test_subject_ids, desc="Evaluating responses"):
-            ground_truth = next(p["ground_truth"] for p in input_payloads if p["subject_id"] == test_subject_id)
-            diagnosis = next(1 if "(B)" in r["diagnosis"] else 0 for r in response_list if r["subject_id"] == test_subject_id)
-            y_true.append(ground_truth)
-            y_pred.append(diagnosis)
+            if test_subject_id not in response_store:
+                continue
+            metrics.update(ground_truths[test_subject_id], response_store[test_subject_id]["diagnosis"])
         
         # Calculate the evaluation metrics
-        tn, fp, fn, tp = confusion_matrix(y_true, y_pred).ravel()
-        metrics = {
-            "accuracy": (tp + tn) / (tp + tn + fp + fn),
-            "precision": tp / (tp + fp) if (tp + fp) > 0 else 0,
-            "sensitivity": tp / (tp + fn) if (tp + fn) > 0 else 0,
-            "specificity": tn / (tn + fp) if (tn + fp) > 0 else 0,
-            "f1_score": (2 * tp / (2 * tp + fp + fn)) if (tp + fp + fn) > 0 else 0
-        }
-        return {"total_samples": len(y_true), **{k: round(v, 4) for k, v in metrics.items()}}
+        return metrics.compute()
 
 
 class RubricResponseEvaluator(ResponseEvaluator):
@@ -132,8 +170,10 @@ class RubricResponseEvaluator(ResponseEvaluator):
         
         # Prepare the batch instructions, responses, and references
         batch_instructions, batch_responses, batch_references = [], [], []
-        for input, output in zip(input_payloads, response_list):
-            batch_instructions.append(input["messages"][0]["content"] + "\n\n" + get_snsb_data_by_subject_id(input["subject_id"], "score"))
+        payload_store = RecordStore(input_payloads)
+        for output in response_list:
+            input = payload_store[output["subject_id"]]
+            batch_instructions.append(resolve_messages(input)[0]["content"] + "\n\n" + get_snsb_data_by_subject_id(input["subject_id"], "score"))
             batch_responses.append(output["generated_response"])
             batch_references.append(get_snsb_data_by_subject_id(input["subject_id"], "report"))
         
@@ -0,0 +1,217 @@
+import os
+import re
+import json
+
+import numpy as np
+
+from lib.utils import compute_text_hash, get_snsb_data_by_subject_id
+
+
+# -------------------------------------------------------------------------
+# Markdown table parsing
+# -------------------------------------------------------------------------
+# Header names of the score columns in the SNSB-C tables
+SCORE_COLUMNS = {
+    "raw": ("raw", "raw score"),
+    "z_score": ("z-score", "z score", "zscore", "z"),
+    "percentile": ("%ile", "percentile", "%"),
+}
+NUMBER_PATTERN = re.compile(r"[-+]?\d*\.?\d+")
+
+
+def parse_markdown_tables(markdown):
+    """
+    Parse the pipe tables in a markdown document into lists of rows of cells.
+    """
+    tables, rows = [], []
+    for line in markdown.splitlines():
+        line = line.strip()
+        if not line.startswith("|"):
+            if rows:
+                tables.append(rows)
+                rows = []
+            continue
+        cells = [cell.strip() for cell in line.strip("|").split("|")]
+        # Skip the separator row below the header
+        if all(re.fullmatch(r":?-+:?", cell) for cell in cells if cell):
+            continue
+        rows.append(cells)
+    if rows:
+        tables.append(rows)
+    return tables
+
+
+def get_score_columns(header):
+    """
+    Map each score measure to its column index in the header row, if the row is a header.
+    """
+    score_columns = {}
+    for i, cell in enumerate(header):
+        name = " ".join(re.sub(r"\(.*?\)", "", cell.lower()).split())
+        for measure, names in SCORE_COLUMNS.items():
+            if measure not in score_columns and name in names:
+                score_columns[measure] = i
+    return score_columns
+
+
+def parse_number(cell):
+    """
+    Parse the first number in a cell (e.g., '<1' -> 1.0, '-1.25 (abnormal)' -> -1.25), or NaN if there is none.
+    """
+    match = NUMBER_PATTERN.search(cell)
+    return float(match.group()) if match else np.nan
+
+
+def parse_snsb_scores(markdown):
+    """
+    Parse the SNSB-C tables of a score document into (test name, raw score, z-score, percentile) records.
+    The test name joins the label columns before the scores (e.g., domain, test, and subtest), which
+    docling repeats for merged cells. A table without a header continues the previous table's columns.
+    """
+    records, names = [], set()
+    score_columns, num_columns = {}, 0
+    for table in parse_markdown_tables(markdown):
+        header_columns = get_score_columns(table[0])
+        if header_columns:
+            score_columns, num_columns, rows = header_columns, len(table[0]), table[1:]
+        elif score_columns and len(table[0]) == num_columns:
+            rows = table
+        else:
+            continue
+
+        first_score_column = min(score_columns.values())
+        for row in rows:
+            if len(row) != num_columns:
+                continue
+            labels = []
+            for cell in row[:first_score_column]:
+                if cell and cell not in labels:
+                    labels.append(cell)
+            scores = {measure: parse_number(row[i]) for measure, i in score_columns.items()}
+            if not labels or all(np.isnan(v) for v in scores.values()):
+                continue
+
+            # Disambiguate tests with the same name
+            name = " / ".join(labels)
+            suffix = 2
+            while name in names:
+                name = f"{' / '.join(labels)} ({suffix})"
+                suffix += 1
+            names.add(name)
+            records.append((name, scores.get("raw", np.nan), scores.get("z_score", np.nan), scores.get("percentile", np.nan)))
+    return records
+
+
+# -------------------------------------------------------------------------
+# Columnar store
+# -------------------------------------------------------------------------
+class SNSBScoreTable:
+    """
+    A columnar store of the SNSB-C scores of a cohort.
+    Each measure (raw, z_score, percentile) is a float32 matrix of subjects x tests, with NaN where
+    a subject has no score for a test.
+    """
+    measures = ("raw", "z_score", "percentile")
+
+    def __init__(self, subject_ids, test_names, raw, z_score, percentile, source_key=""):
+        self.subject_ids = list(subject_ids)
+        self.test_names = list(test_names)
+        self.raw = raw
+        self.z_score = z_score
+        self.percentile = percentile
+        self.source_key = source_key
+        self._subject_index = {subject_id: i for i, subject_id in enumerate(self.subject_ids)}
+
+    @classmethod
+    def from_documents(cls, documents, source_key=""):
+        """
+        Build the table from the score documents, keyed by subject ID.
+        """
+        parsed = {subject_id: parse_snsb_scores(markdown or "") for subject_id, markdown in documents.items()}
+        test_names = list(dict.fromkeys(name for records in parsed.values() for name, *_ in records))
+        test_index = {test_name: j for j, test_name in enumerate(test_names)}
+
+        columns = {measure: np.full((len(parsed), len(test_names)), np.nan, dtype=np.float32) for measure in cls.measures}
+        for i, records in enumerate(parsed.values()):
+            for name, *scores in records:
+                for measure, score in zip(cls.measures, scores):
+                    columns[measure][i, test_index[name]] = score
+        return cls(list(parsed), test_names, source_key=source_key, **columns)
+
+    @classmethod
+    def load(cls, table_path):
+        with np.load(table_path, allow_pickle=False) as data:
+            return cls(
+                data["subject_ids"].tolist(), data["test_names"].tolist(),
+                data["raw"], data["z_score"], data["percentile"], str(data["source_key"]),
+            )
+
+    def save(self, table_path):
+        """
+        Save the table as a NumPy archive (written atomically).
+        """
+        os.makedirs(os.path.dirname(table_path), exist_ok=True)
+        tmp_table_path = f"{table_path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_table_path,
+            subject_ids=np.array(self.subject_ids), test_names=np.array(self.test_names),
+            raw=self.raw, z_score=self.z_score, percentile=self.percentile,
+            source_key=np.array(self.source_key),
+        )
+        os.replace(tmp_table_path, table_path)
+
+    def get_measure(self, measure, subject_ids=None):
+        """
+        Get the matrix of a measure, for the given subjects (in that order) or the whole cohort.
+        """
+        if measure not in self.measures:
+            raise ValueError(f"Unsupported SNSB score measure: {measure}.")
+        matrix = getattr(self, measure)
+        if subject_ids is None:
+            return matrix
+        return matrix[[self._subject_index[subject_id] for subject_id in subject_ids]]
+
+    def get_scores(self, subject_id):
+        """
+        Get a subject's scores as {test name: {measure: score}}, leaving out missing tests.
+        """
+        i = self._subject_index[subject_id]
+        scores = {}
+        for j, test_name in enumerate(self.test_names):
+            row = {measure: float(getattr(self, measure)[i, j]) for measure in self.measures}
+            if not all(np.isnan(v) for v in row.values()):
+                scores[test_name] = row
+        return scores
+
+    def has_measure(self, measure, subject_id):
+        """
+        Check whether a subject has any score of a measure (e.g., not a missing or unparseable score document).
+        """
+        if subject_id not in self._subject_index:
+            return False
+        return bool(np.any(~np.isnan(self.get_measure(measure)[self._subject_index[subject_id]])))
+
+    def __contains__(self, subject_id):
+        return subject_id in self._subject_index
+
+    def __len__(self):
+        return len(self.subject_ids)
+
+
+def load_snsb_score_table(subject_ids, table_path="data/processed/SNSB/scores.npz"):
+    """
+    Load the SNSB-C score table of the subjects, rebuilding it when any of their score documents changed.
+    """
+    documents = {subject_id: get_snsb_data_by_subject_id(subject_id, "score") for subject_id in subject_ids}
+    source_key = compute_text_hash(json.dumps(documents, sort_keys=True))
+    if os.path.exists(table_path):
+        table = SNSBScoreTable.load(table_path)
+        if table.source_key == source_key:
+            return table
+
+    print("Building the SNSB-C score table...")
+    table = SNSBScoreTable.from_documents(documents, source_key=source_key)
+    table.save(table_path)
+    print(f"- Num of subjects: {len(table)}")
+    print(f"- Num of tests: {len(table.test_names)}")
+    return table
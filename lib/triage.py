@@ -0,0 +1,87 @@
+import numpy as np
+
+
+class TriageClassifier:
+    """
+    A fast-path classifier that settles the clear-cut subjects before the LLM calls.
+    Each subject is scored by the number of tests with a z-score at or below `z_cutoff`, computed for
+    the whole cohort at once from the SNSB-C score table. Subjects with at most `max_normal` impaired
+    tests are triaged as (A), subjects with at least `min_impaired` impaired tests as (B), and the
+    rest are left to the LLM. The thresholds are fitted on the source set.
+    """
+    z_cutoffs = (-1.0, -1.5, -2.0)
+
+    def __init__(self, z_cutoff=-1.5, max_normal=-1, min_impaired=np.inf):
+        self.z_cutoff = z_cutoff
+        self.max_normal = max_normal
+        self.min_impaired = min_impaired
+
+    def count_impaired(self, score_table, subject_ids):
+        """
+        Count the impaired tests of each subject.
+        """
+        z_scores = score_table.get_measure("z_score", subject_ids)
+        return np.sum(z_scores <= self.z_cutoff, axis=1)
+
+    def predict(self, score_table, subject_ids):
+        """
+        Triage the subjects: 0 for (A), 1 for (B), and -1 for the ambiguous subjects left to the LLM.
+        Subjects without z-scores are always left to the LLM.
+        """
+        subject_ids = list(subject_ids)
+        predictions = np.full(len(subject_ids), -1)
+        scored = np.array([score_table.has_measure("z_score", subject_id) for subject_id in subject_ids], dtype=bool)
+        if scored.any():
+            num_impaired = self.count_impaired(score_table, [s for s, ok in zip(subject_ids, scored) if ok])
+            scored_predictions = np.full(len(num_impaired), -1)
+            scored_predictions[num_impaired <= self.max_normal] = 0
+            scored_predictions[num_impaired >= self.min_impaired] = 1
+            predictions[scored] = scored_predictions
+        return predictions
+
+    @classmethod
+    def fit(cls, score_table, source_subject_ids, labels, min_precision=0.95, min_support=3):
+        """
+        Fit the thresholds on the source subjects (labels: 0 for HC, 1 for MCI). For each z-score cutoff,
+        the widest (A) and (B) rules whose precision on the source set is at least `min_precision`
+        (over at least `min_support` subjects) are kept, and the cutoff triaging the most subjects wins.
+        """
+        source_subject_ids = [s for s in source_subject_ids if score_table.has_measure("z_score", s)]
+        labels = np.array([labels[s] for s in source_subject_ids])
+        best, best_coverage = cls(), 0
+        for z_cutoff in cls.z_cutoffs:
+            num_impaired = cls(z_cutoff).count_impaired(score_table, source_subject_ids)
+            thresholds = np.unique(num_impaired)
+
+            max_normal = -1
+            for threshold in thresholds:
+                selected = num_impaired <= threshold
+                if selected.sum() >= min_support and np.mean(labels[selected] == 0) >= min_precision:
+                    max_normal = threshold
+            min_impaired = np.inf
+            for threshold in thresholds[::-1]:
+                selected = num_impaired >= threshold
+                if threshold > max_normal and selected.sum() >= min_support and np.mean(labels[selected] == 1) >= min_precision:
+                    min_impaired = threshold
+
+            coverage = np.sum((num_impaired <= max_normal) | (num_impaired >= min_impaired))
+            if coverage > best_coverage:
+                best, best_coverage = cls(z_cutoff, max_normal, min_impaired), coverage
+        return best
+
+    def describe(self):
+        return {
+            "z_cutoff": self.z_cutoff,
+            "max_impaired_tests_for_A": int(self.max_normal),
+            "min_impaired_tests_for_B": None if np.isinf(self.min_impaired) else int(self.min_impaired),
+        }
+
+
+def build_triage_responses(subject_ids, predictions):
+    """
+    Build the responses of the triaged subjects in the same format as the LLM responses.
+    """
+    return [
+        {"subject_id": subject_id, "diagnosis": "(B)" if prediction == 1 else "(A)", "generated_response": "", "triaged": True}
+        for subject_id, prediction in zip(subject_ids, predictions) if prediction != -1
+    ]
@@ -1,6 +1,9 @@
 import os
+import json
 import random
+import hashlib
 import jsonlines
+from functools import lru_cache
 
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
@@ -15,6 +18,153 @@ def load_jsonl(file_path):
         return [record for record in reader]
 
 
+class RecordStore:
+    """
+    A keyed store of records (e.g., payloads or responses) for O(1) lookups by subject ID.
+    Records without the key (e.g., failed responses) are skipped, and the first record
+    for a given key is kept.
+    """
+    def __init__(self, records=(), key="subject_id"):
+        self.key = key
+        self._records = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        """
+        Add a record to the store.
+        """
+        if self.key in record:
+            self._records.setdefault(record[self.key], record)
+
+    def get(self, subject_id, default=None):
+        return self._records.get(subject_id, default)
+
+    def __getitem__(self, subject_id):
+        return self._records[subject_id]
+
+    def __contains__(self, subject_id):
+        return subject_id in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records.values())
+
+
+def write_text_atomic(file_path, text):
+    """
+    Write text to a file atomically, so that readers (and other workers) never see a partly written file.
+    """
+    tmp_file_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_file_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_file_path, file_path)
+
+
+def compute_text_hash(text):
+    """
+    Compute the SHA-256 hash of the given text.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def compute_file_hash(file_path, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 hash of the file's content.
+    """
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class TextCache:
+    """
+    A content-addressed on-disk cache of texts, keyed by hash.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get(self, key):
+        """
+        Get the cached text for the key, or None if it is not cached.
+        """
+        cache_path = self._get_path(key)
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as f:
+                return f.read()
+        return None
+
+    def set(self, key, text):
+        """
+        Cache the text under the key.
+        """
+        cache_path = self._get_path(key)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        write_text_atomic(cache_path, text)
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.txt")
+
+
+class BlockStore(TextCache):
+    """
+    A content-addressed store of text blocks shared across payloads (e.g., the system prompt, or the
+    prompt template rendered with the diagnostic guideline). Each block is stored once and kept in
+    memory once it has been read.
+    """
+    def __init__(self, cache_dir):
+        super().__init__(cache_dir)
+        self._blocks = {}
+
+    def put(self, text):
+        """
+        Store the text block and get its key.
+        """
+        key = compute_text_hash(text)
+        if key not in self._blocks:
+            if self.get(key) is None:
+                self.set(key, text)
+            self._blocks[key] = text
+        return key
+
+    def get(self, key):
+        if key not in self._blocks:
+            text = super().get(key)
+            if text is None:
+                return None
+            self._blocks[key] = text
+        return self._blocks[key]
+
+
+payload_block_store = BlockStore("data/payloads/blocks")
+
+
+def resolve_messages(payload):
+    """
+    Get the messages of the payload, assembling the messages of a compact payload from its shared
+    blocks and inline parts.
+    """
+    if "messages" in payload:
+        return payload["messages"]
+    messages = []
+    for message in payload["message_parts"]:
+        content = []
+        for part in message["parts"]:
+            if isinstance(part, str):
+                content.append(part)
+                continue
+            block = payload_block_store.get(part["block"])
+            if block is None:
+                raise ValueError(f"Missing payload block: {part['block']}.")
+            content.append(block)
+        messages.append({"role": message["role"], "content": "".join(content)})
+    return messages
+
+
 def sample_source_set(info_dataset, source_ratio=0.1):
     """
     Splits the dataset into source and test sets based on the given source ratio.
@@ -41,100 +191,145 @@ def sample_source_set(info_dataset, source_ratio=0.1):
     return source_subject_ids, test_subject_ids
 
 
+class SNSBDataStore:
+    """
+    An in-memory index of the processed SNSB scores and reports.
+    Each directory is read once and re-indexed only when its modification time changes,
+    i.e., when a processed file is added, removed, or replaced. The temporary files of
+    atomic writes in progress are left out.
+    """
+    def __init__(self, dir_paths=None):
+        self.dir_paths = dir_paths or {
+            "score": "data/processed/SNSB/scores/",
+            "report": "data/processed/SNSB/reports/eng/"
+        }
+        self._documents = {}
+        self._prefixes = {}
+        self._mtimes = {}
+
+    def get(self, subject_id, data_type):
+        """
+        Retrieve SNSB data for a given subject ID and data type.
+        """
+        documents = self._get_documents(data_type)
+        document = documents.get(f"{subject_id}.md")
+        if document is not None:
+            return document
+        # Otherwise, the first file (in sorted order) whose name starts with the subject ID
+        file_name = self._prefixes[data_type].get(subject_id)
+        return documents[file_name] if file_name is not None else None
+
+    def _get_documents(self, data_type):
+        """
+        Get the indexed documents of the given data type, re-indexing the directory if it changed.
+        """
+        if data_type not in self.dir_paths:
+            raise ValueError(f"Unsupported SNSB data type: {data_type}.")
+        dir_path = self.dir_paths[data_type]
+        
+        mtime = os.stat(dir_path).st_mtime_ns
+        if self._mtimes.get(data_type) != mtime:
+            documents, prefixes = {}, {}
+            for file_name in sorted(os.listdir(dir_path)):
+                file_path = os.path.join(dir_path, file_name)
+                if file_name.endswith(".tmp") or not os.path.isfile(file_path):
+                    continue
+                with open(file_path, 'r', encoding='utf-8') as file:
+                    documents[file_name] = file.read()
+                for i in range(1, len(file_name) + 1):
+                    prefixes.setdefault(file_name[:i], file_name)
+            self._documents[data_type] = documents
+            self._prefixes[data_type] = prefixes
+            self._mtimes[data_type] = mtime
+        return self._documents[data_type]
+
+
+snsb_data_store = SNSBDataStore()
+
+
 def get_snsb_data_by_subject_id(subject_id, data_type):
     """
     Retrieve SNSB data for a given subject ID and data type.
     """
-    dir_paths = {
-        "score": "data/processed/SNSB/scores/",
-        "report": "data/processed/SNSB/reports/eng/"
-    }
-    dir_path = dir_paths.get(data_type)
-    
-    for file_name in os.listdir(dir_path):
-        if file_name.startswith(subject_id):
-            with open(os.path.join(dir_path, file_name), 'r', encoding='utf-8') as file:
-                return file.read()
-    return None
+    return snsb_data_store.get(subject_id, data_type)
     
 
-def get_examples_for_fewshot(num_examples, source_subject_ids):
+class Translator:
     """
-    Get few-shot examples based on the number of examples requested.
+    Translates texts through a single reusable chain, running up to `max_concurrency` translations
+    at once and memoising the translations on disk by the hash of the source text.
     """
-    # 1-shot
-    if num_examples == 1:
-        example_subject_ids = random.sample(source_subject_ids, num_examples)
-        
-        example_list = []
-        for example_subject_id in example_subject_ids:
-            snsb_scores = get_snsb_data_by_subject_id(example_subject_id, "score")
-            snsb_report = get_snsb_data_by_subject_id(example_subject_id, "report")
-            example_list.append(
-                f"### SNSB-C Result\n{snsb_scores}\n\n"
-                f"### Clinical Rationale\n{snsb_report.split('\n\n')[0]}\n\n"
-                f"### Diagnosis\n{snsb_report.split('\n\n')[1]}"
+    def __init__(self, source_language, target_language, model="gpt-4o", max_concurrency=8,
+                 cache_dir="data/cache/translations"):
+        self.source_language = source_language
+        self.target_language = target_language
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.cache = TextCache(cache_dir)
+        self._translator = None
+
+    @property
+    def translator(self):
+        """
+        The translation chain, created on first use so that runs with nothing to translate need no API key.
+        """
+        if self._translator is None:
+            prompt = ChatPromptTemplate.from_template(
+                "Translate the following {source_language} text to {target_language}: \n\n{text}\n\nTranslation:"
             )
+            self._translator = prompt | ChatOpenAI(model=self.model) | StrOutputParser()
+        return self._translator
+
+    def translate(self, text):
+        """
+        Translates a text from the source language to the target language.
+        """
+        return self.translate_batch([text])[0]
+
+    def translate_batch(self, texts):
+        """
+        Translates the texts concurrently, calling the LLM only for texts that are not cached.
+        The successful translations are cached even if some of them fail.
+        """
+        keys = [self._get_key(text) for text in texts]
+        translations = {key: self.cache.get(key) for key in keys}
         
-    # 2-shot or more
-    elif num_examples > 1:
-        info_dataset = load_jsonl("data/processed/info.jsonl")
-        
-        hc_subject_ids = []
-        mci_subject_ids = []
-
-        for source_subject_id in source_subject_ids:
-            group = [info_data["group"] for info_data in info_dataset if info_data["subject_id"] == source_subject_id][0]
-            if group == 0:
-                hc_subject_ids.append(source_subject_id)
-            elif group == 1:
-                mci_subject_ids.append(source_subject_id)
-        
-        hc_sample_ids = random.sample(hc_subject_ids, num_examples // 2)
-        hc_examples = []
-        for hc_subject_id in hc_sample_ids:
-            hc_snsb_scores = get_snsb_data_by_subject_id(hc_subject_id, "score")
-            hc_snsb_report = get_snsb_data_by_subject_id(hc_subject_id, "report")
-            hc_examples.append(
-                f"### SNSB-C Result\n{hc_snsb_scores}\n\n"
-                f"### Clinical Rationale\n{hc_snsb_report.split('\n\n')[0]}\n\n"
-                f"### Diagnosis\n{hc_snsb_report.split('\n\n')[1]}"
+        # Translate each uncached text once
+        pending = {key: text for key, text in zip(keys, texts) if translations[key] is None}
+        if pending:
+            outputs = self.translator.batch(
+                [
+                    {"source_language": self.source_language, "target_language": self.target_language, "text": text}
+                    for text in pending.values()
+                ],
+                config={"max_concurrency": self.max_concurrency},
+                return_exceptions=True,
             )
+            errors = []
+            for key, output in zip(pending, outputs):
+                if isinstance(output, Exception):
+                    errors.append(output)
+                    continue
+                self.cache.set(key, output)
+                translations[key] = output
+            if errors:
+                raise errors[0]
+        return [translations[key] for key in keys]
 
-        mci_sample_ids = random.sample(mci_subject_ids, num_examples // 2)
-        mci_examples = []
-        for mci_subject_id in mci_sample_ids:
-            mci_snsb_scores = get_snsb_data_by_subject_id(mci_subject_id, "score")
-            mci_snsb_report = get_snsb_data_by_subject_id(mci_subject_id, "report")
-            mci_examples.append(
-                f"### SNSB-C Result\n{mci_snsb_scores}\n\n"
-                f"### Clinical Rationale\n{mci_snsb_report.split('\n\n')[0]}\n\n"
-                f"### Diagnosis\n{mci_snsb_report.split('\n\n')[1]}"
-            )
+    def _get_key(self, text):
+        return compute_text_hash(json.dumps([self.model, self.source_language, self.target_language, text]))
 
-        example_list = hc_examples + mci_examples
-        random.shuffle(example_list)
-    
-    # Format the examples
-    example_str = ""
-    for i, example in enumerate(example_list):
-        example_str += f"Example {i+1}.\n{example}\n\n"
-        
-    return example_str
+
+@lru_cache(maxsize=None)
+def get_translator(source_language, target_language):
+    """
+    Get the shared translator for the language pair.
+    """
+    return Translator(source_language, target_language)
 
 
 def translate_text(text, source_language, target_language):
     """
     Translates text from the source language to the target language.
     """
-    prompt = ChatPromptTemplate.from_template(
-        "Translate the following {source_language} text to {target_language}: \n\n{text}\n\nTranslation:"
-    )
-    llm = ChatOpenAI(model="gpt-4o")
-    translator = prompt | llm | StrOutputParser()
-    
-    return translator.invoke({
-        "source_language": source_language,
-        "target_language": target_language,
-        "text": text
-    })
\ No newline at end of file
+    return get_translator(source_language, target_language).translate(text)
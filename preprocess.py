@@ -3,10 +3,12 @@ import json
 import argparse
 import pandas as pd
 from tqdm import tqdm
+from importlib.metadata import version, PackageNotFoundError
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from docling.document_converter import DocumentConverter
 
-from lib.utils import load_jsonl, translate_text
+from lib.utils import load_jsonl, Translator, write_text_atomic, compute_file_hash, compute_text_hash
 
 
 def get_args():
@@ -14,9 +16,186 @@ def get_args():
     parser.add_argument('--info_data_path', type=str, default='data/raw/VEEM 대상자 정보.xlsx')
     parser.add_argument('--snsb_data_path', type=str, default='data/raw/SNSB/')
     parser.add_argument('--output_dir_path', type=str, default='data/processed')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--translation_concurrency', type=int, default=8)
     return parser.parse_args()
 
 
+# The document converter of the current process (one per worker)
+converter = None
+
+def get_converter_version():
+    try:
+        return f"docling=={version('docling')}"
+    except PackageNotFoundError:
+        return "docling"
+
+
+# Converter and extraction settings of each output; changing them invalidates the converted files
+SNSB_SCORE_SETTINGS = {"converter": get_converter_version(), "start_section": 3}
+SNSB_REPORT_SETTINGS = {
+    "converter": get_converter_version(),
+    "start_section": "Neuropsychological Assessment Summary & Conclusions",
+    "end_section": "| K-MMSE-2",
+}
+SNSB_TRANSLATION_SETTINGS = {"model": "gpt-4o", "source_language": "Korean", "target_language": "English"}
+
+
+class ConversionManifest:
+    """
+    A manifest of the converted files, keyed by the output file path.
+    Each entry records the content hash of the source and the converter version and extraction
+    settings, so only new or changed documents are converted again. The source's size and
+    modification time are also recorded so unchanged files are not re-hashed.
+    The entries are saved every `save_every` records and on `save`, so a crash loses at most
+    the last unsaved records, whose outputs are then converted again.
+    """
+    def __init__(self, manifest_path, save_every=50):
+        self.manifest_path = manifest_path
+        self.save_every = save_every
+        self.num_unsaved = 0
+        self.entries = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def is_up_to_date(self, output_file_path, settings, file_path=None, text=None):
+        """
+        Check whether the output was converted from the current source (a file or a text) with
+        the current settings.
+        """
+        entry = self.entries.get(self._get_key(output_file_path))
+        if entry is None or not os.path.exists(output_file_path):
+            return False
+        if entry["settings"] != settings:
+            return False
+        return entry["source_hash"] == self._get_source_hash(entry, file_path, text)
+
+    def record(self, output_file_path, settings, file_path=None, text=None):
+        """
+        Record the conversion of the source into the output, saving the manifest every `save_every` records.
+        """
+        key = self._get_key(output_file_path)
+        entry = {
+            "source_hash": self._get_source_hash(self.entries.get(key), file_path, text),
+            "settings": settings,
+        }
+        if file_path is not None:
+            stat = os.stat(file_path)
+            entry.update({"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns})
+        self.entries[key] = entry
+        self.num_unsaved += 1
+        if self.num_unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        """
+        Save the recorded entries to the manifest file.
+        """
+        if self.num_unsaved:
+            write_text_atomic(self.manifest_path, json.dumps(self.entries, ensure_ascii=False, indent=2))
+            self.num_unsaved = 0
+
+    def _get_key(self, output_file_path):
+        return os.path.relpath(output_file_path, os.path.dirname(self.manifest_path))
+
+    @staticmethod
+    def _get_source_hash(entry, file_path, text):
+        """
+        Get the source's content hash, reusing the recorded hash if the file is unchanged.
+        """
+        if file_path is None:
+            return compute_text_hash(text)
+        stat = os.stat(file_path)
+        if (
+            entry is not None
+            and entry.get("source_size") == stat.st_size
+            and entry.get("source_mtime_ns") == stat.st_mtime_ns
+        ):
+            return entry["source_hash"]
+        return compute_file_hash(file_path)
+
+
+def init_converter():
+    """
+    Initialize the document converter of the current process.
+    """
+    global converter
+    converter = DocumentConverter()
+
+
+def convert_to_markdown_sections(file_path):
+    """
+    Convert the document to markdown and split it into sections.
+    """
+    result = converter.convert(file_path)
+    result_markdown = result.document.export_to_markdown()
+    return result_markdown.split("\n\n")
+
+
+def convert_snsb_score(snsb_score_file_path, processed_snsb_score_file_path):
+    """
+    Convert an SNSB score PDF to markdown and save the extracted scores.
+    """
+    markdown_sections = convert_to_markdown_sections(snsb_score_file_path)
+    
+    # Save the extracted SNSB scores
+    snsb_scores = "\n\n".join(markdown_sections[SNSB_SCORE_SETTINGS["start_section"]:])
+    write_text_atomic(processed_snsb_score_file_path, snsb_scores)
+    return snsb_scores
+
+
+def convert_snsb_report(snsb_report_file_path, processed_snsb_report_kor_file_path):
+    """
+    Convert an SNSB report DOCX to markdown and save the extracted rationales and diagnosis.
+    """
+    markdown_sections = convert_to_markdown_sections(snsb_report_file_path)
+    
+    # Extract the rationales and diagnosis
+    start_idx = markdown_sections.index(SNSB_REPORT_SETTINGS["start_section"]) + 1
+    end_idx = next(i for i, section in enumerate(markdown_sections) if SNSB_REPORT_SETTINGS["end_section"] in section)
+    
+    # Save the extracted rationales and diagnosis
+    diagnosis_with_rationales_kor = "\n\n".join(markdown_sections[start_idx:end_idx])
+    write_text_atomic(processed_snsb_report_kor_file_path, diagnosis_with_rationales_kor)
+    return diagnosis_with_rationales_kor
+
+
+def run_conversions(convert_fn, tasks, workers, desc, on_complete=None):
+    """
+    Run the document conversions, in a process pool with one converter per worker if `workers` > 1.
+    Args:
+        convert_fn (callable): Function converting a source file and saving it to the output file.
+        tasks (dict): Mapping of subject IDs to (source file path, output file path).
+        workers (int): Number of worker processes.
+        desc (str): Description for the progress bar.
+        on_complete (callable, optional): Called with the subject ID once its conversion is saved.
+    Returns:
+        dict: Mapping of subject IDs to the converted text.
+    """
+    results = {}
+    if workers <= 1:
+        if converter is None and tasks:
+            init_converter()
+        for subject_id, (file_path, output_file_path) in tqdm(tasks.items(), desc=desc):
+            print(f"Converting {file_path}...")
+            results[subject_id] = convert_fn(file_path, output_file_path)
+            if on_complete is not None:
+                on_complete(subject_id)
+        return results
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_converter) as executor:
+        futures = {
+            executor.submit(convert_fn, file_path, output_file_path): subject_id
+            for subject_id, (file_path, output_file_path) in tasks.items()
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            results[futures[future]] = future.result()
+            if on_complete is not None:
+                on_complete(futures[future])
+    return results
+
+
 def preprocess_info_dataset(args, subject_id_list):
     """
     Preprocess the subjects' information dataset and save it to a JSONL file.
@@ -74,15 +253,14 @@ def preprocess_snsb_score(args, info_dataset):
     """
     processed_snsb_score_dir_path = os.path.join(args.output_dir_path, "SNSB/scores")
     os.makedirs(processed_snsb_score_dir_path, exist_ok=True)
-    
-    # Initialize the document converter
-    converter = DocumentConverter()
+    manifest = ConversionManifest(os.path.join(args.output_dir_path, "manifest.json"))
     
     # Define the directory paths
     snsb_score_dir_path = os.path.join(args.snsb_data_path, "scores")
     
     # Get the list of subject names from the info dataset
     subject_name_list = [info_data['name'] for info_data in info_dataset]
+    conversion_tasks = {}
     for snsb_score_filename in tqdm(
         os.listdir(snsb_score_dir_path), desc="Processing SNSB scores",
     ):
@@ -111,21 +289,22 @@ def preprocess_snsb_score(args, info_dataset):
             processed_snsb_score_dir_path, f"{subject_id}.md"
         )
         
-        # Check if the file already exists
-        if os.path.exists(processed_snsb_score_file_path):
-            print(f"File already exists: {processed_snsb_score_file_path}")
+        # Check if the file is already converted from the same source
+        if manifest.is_up_to_date(processed_snsb_score_file_path, SNSB_SCORE_SETTINGS, file_path=snsb_score_file_path):
             continue
-        print(f"Processing SNSB score for subject {subject_id}...")
-        
-        # Convert the document to markdown
-        result = converter.convert(snsb_score_file_path)
-        result_markdown = result.document.export_to_markdown()
-        markdown_sections = result_markdown.split("\n\n")                
-        
-        # Save the extracted SNSB scores
-        snsb_scores = "\n\n".join(markdown_sections[3:])        
-        with open(processed_snsb_score_file_path, "w", encoding="utf-8") as md_file:
-            md_file.write(snsb_scores)
+        conversion_tasks[subject_id] = (snsb_score_file_path, processed_snsb_score_file_path)
+    
+    # Convert the documents to markdown
+    print(f"Converting {len(conversion_tasks)} new or changed SNSB scores...")
+    try:
+        run_conversions(
+            convert_snsb_score, conversion_tasks, args.workers, desc="Converting SNSB scores",
+            on_complete=lambda subject_id: manifest.record(
+                conversion_tasks[subject_id][1], SNSB_SCORE_SETTINGS, file_path=conversion_tasks[subject_id][0]
+            ),
+        )
+    finally:
+        manifest.save()
                 
     print(f"Total number of SNSB scores: {len(os.listdir(processed_snsb_score_dir_path))}")
     return None
@@ -138,14 +317,16 @@ def preprocess_snsb_report(args):
     processed_snsb_report_dir_path = os.path.join(args.output_dir_path, "SNSB/reports")
     os.makedirs(f"{processed_snsb_report_dir_path}/kor", exist_ok=True)
     
-    # Initialize the document converter
-    converter = DocumentConverter()
-    
     # Define the directory paths
     snsb_report_dir_path = os.path.join(args.snsb_data_path, "reports")
+    processed_snsb_report_kor_dir_path = os.path.join(processed_snsb_report_dir_path, "kor")
+    processed_snsb_report_eng_dir_path = os.path.join(processed_snsb_report_dir_path, "eng")
+    os.makedirs(processed_snsb_report_eng_dir_path, exist_ok=True)
+    manifest = ConversionManifest(os.path.join(args.output_dir_path, "manifest.json"))
     
     # Get the list of subject IDs from the SNSB report directory
     subject_id_list = []
+    conversion_tasks = {}
     for snsb_report_filename in tqdm(
         os.listdir(snsb_report_dir_path), desc="Processing SNSB reports",
     ):
@@ -162,61 +343,79 @@ def preprocess_snsb_report(args):
         # ---------------------------------------------------------------------
         snsb_report_file_path = os.path.join(snsb_report_dir_path, snsb_report_filename)
         
-        # Define the directory path for the processed SNSB report
-        processed_snsb_report_kor_dir_path = f"{processed_snsb_report_dir_path}/kor"
-        os.makedirs(processed_snsb_report_kor_dir_path, exist_ok=True)
-        
         # Define the file path for the processed SNSB report
         processed_snsb_report_kor_file_path = os.path.join(
             processed_snsb_report_kor_dir_path, f"{subject_id}.md"
         )
 
-        # Check if the file already exists
-        if os.path.exists(processed_snsb_report_kor_file_path):
-            print(f"File already exists: {processed_snsb_report_kor_file_path}")
+        # Check if the file is already converted from the same source
+        if manifest.is_up_to_date(processed_snsb_report_kor_file_path, SNSB_REPORT_SETTINGS, file_path=snsb_report_file_path):
             continue
-        print(f"Processing SNSB report for subject {subject_id}...")
-        
-        # Convert the document to markdown
-        result = converter.convert(snsb_report_file_path)
-        result_markdown = result.document.export_to_markdown()
-        markdown_sections = result_markdown.split("\n\n")                
-        
-        # Extract the rationales and diagnosis
-        start_idx = markdown_sections.index("Neuropsychological Assessment Summary & Conclusions") + 1
-        end_idx = next(i for i, section in enumerate(markdown_sections) if "| K-MMSE-2" in section)
-        
-        # Save the extracted rationales and diagnosis
-        diagnosis_with_rationales_kor = "\n\n".join(markdown_sections[start_idx:end_idx])
-        with open(processed_snsb_report_kor_file_path, "w", encoding="utf-8") as md_file:
-            md_file.write(diagnosis_with_rationales_kor)
-        
+        conversion_tasks[subject_id] = (snsb_report_file_path, processed_snsb_report_kor_file_path)
+    
+    # Keep the previous Korean texts to reuse the translations of unchanged reports
+    previous_reports_kor = {}
+    for subject_id, (_, processed_snsb_report_kor_file_path) in conversion_tasks.items():
+        if os.path.exists(processed_snsb_report_kor_file_path):
+            with open(processed_snsb_report_kor_file_path, "r", encoding="utf-8") as md_file:
+                previous_reports_kor[subject_id] = md_file.read()
+    
+    try:
+        # Convert the documents to markdown
+        print(f"Converting {len(conversion_tasks)} new or changed SNSB reports...")
+        run_conversions(
+            convert_snsb_report, conversion_tasks, args.workers, desc="Converting SNSB reports",
+            on_complete=lambda subject_id: manifest.record(
+                conversion_tasks[subject_id][1], SNSB_REPORT_SETTINGS, file_path=conversion_tasks[subject_id][0]
+            ),
+        )
+    
         # ----------------------------------------------------------------------
         # Process the SNSB report in English
         # ---------------------------------------------------------------------
-        processed_snsb_report_eng_dir_path = os.path.join(processed_snsb_report_dir_path, "eng")
-        os.makedirs(processed_snsb_report_eng_dir_path, exist_ok=True)
-        
-        # Define the file path for the processed SNSB report
-        processed_snsb_report_eng_file_path = os.path.join(
-            processed_snsb_report_eng_dir_path, f"{subject_id}.md"
-        )
+        translation_tasks = {}
+        for subject_id in subject_id_list:
+            # Define the file paths for the processed SNSB report
+            processed_snsb_report_kor_file_path = os.path.join(
+                processed_snsb_report_kor_dir_path, f"{subject_id}.md"
+            )
+            processed_snsb_report_eng_file_path = os.path.join(
+                processed_snsb_report_eng_dir_path, f"{subject_id}.md"
+            )
+            with open(processed_snsb_report_kor_file_path, "r", encoding="utf-8") as md_file:
+                diagnosis_with_rationales_kor = md_file.read()
         
-        # Check if the file already exists
-        if os.path.exists(processed_snsb_report_eng_file_path):
-            print(f"File already exists: {processed_snsb_report_eng_file_path}")
-            continue
+            # Check if the file is already translated from the same Korean text
+            if manifest.is_up_to_date(processed_snsb_report_eng_file_path, SNSB_TRANSLATION_SETTINGS, text=diagnosis_with_rationales_kor):
+                continue
         
-        # Translate the Korean text to English
-        diagnosis_with_rationales_eng = translate_text(
-            text=diagnosis_with_rationales_kor,
-            source_language="Korean",
-            target_language="English"
+            # Keep the existing translation if the Korean text did not change on re-conversion
+            if (
+                os.path.exists(processed_snsb_report_eng_file_path)
+                and previous_reports_kor.get(subject_id) == diagnosis_with_rationales_kor
+            ):
+                manifest.record(processed_snsb_report_eng_file_path, SNSB_TRANSLATION_SETTINGS, text=diagnosis_with_rationales_kor)
+                continue
+            translation_tasks[processed_snsb_report_eng_file_path] = diagnosis_with_rationales_kor
+    
+        # Translate the Korean texts to English
+        print(f"Translating {len(translation_tasks)} new or changed SNSB reports...")
+        translator = Translator(
+            source_language=SNSB_TRANSLATION_SETTINGS["source_language"],
+            target_language=SNSB_TRANSLATION_SETTINGS["target_language"],
+            model=SNSB_TRANSLATION_SETTINGS["model"],
+            max_concurrency=args.translation_concurrency,
         )
-        
-        # Save the translated text
-        with open(processed_snsb_report_eng_file_path, "w", encoding="utf-8") as md_file:
-            md_file.write(diagnosis_with_rationales_eng)
+        translations = translator.translate_batch(list(translation_tasks.values()))
+    
+        # Save the translated texts
+        for (processed_snsb_report_eng_file_path, diagnosis_with_rationales_kor), diagnosis_with_rationales_eng in zip(
+            translation_tasks.items(), translations
+        ):
+            write_text_atomic(processed_snsb_report_eng_file_path, diagnosis_with_rationales_eng)
+            manifest.record(processed_snsb_report_eng_file_path, SNSB_TRANSLATION_SETTINGS, text=diagnosis_with_rationales_kor)
+    finally:
+        manifest.save()
     
     print(f"Total number of SNSB reports: {len(os.listdir(processed_snsb_report_kor_dir_path))}")
     return subject_id_list
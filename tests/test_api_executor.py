@@ -0,0 +1,106 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from lib.api_executor import APIExecutor, DiagnosisStreamParser, VllmAPIExecutor
+
+
+THINKING_RESPONSE = (
+    "<think>The answer should end with ### Diagnosis (A) or (B).</think>\n"
+    "### Clinical Rationale\nDelayed recall is impaired.\n\n### Diagnosis\n(B) Mild cognitive impairment"
+)
+
+
+def test_streamed_and_cached_responses_share_the_diagnosis(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api_executor = APIExecutor("model", api_key=None)
+    payload = {"subject_id": "a", "messages": [{"role": "user", "content": "Diagnose."}], "temperature": 0.1}
+
+    parser = DiagnosisStreamParser()
+    for i in range(0, len(THINKING_RESPONSE), 7):
+        if parser.feed(THINKING_RESPONSE[i:i + 7]):
+            break
+    streamed_response = api_executor.build_streamed_response(payload, parser)
+
+    api_executor.save_response_to_cache(payload, api_executor.build_response(payload, THINKING_RESPONSE))
+    cached_response = api_executor.load_response_from_cache(payload)
+
+    assert streamed_response["diagnosis"] == cached_response["diagnosis"] == "(B)"
+    assert cached_response["cached"] is True
+
+
+@pytest.fixture
+def stub_server():
+    """
+    A local OpenAI-compatible chat completions server, answering (B) to subjects whose prompt mentions MCI.
+    """
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            requests.append((self.path, body))
+            label = "(B)" if "MCI" in body["messages"][-1]["content"] else "(A)"
+            completion = {
+                "id": "chatcmpl-0", "object": "chat.completion", "created": 0, "model": body["model"],
+                "choices": [{
+                    "index": 0, "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": f"### Clinical Rationale\nOK.\n\n### Diagnosis\n{label}"},
+                }],
+            }
+            data = json.dumps(completion).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1", requests
+    server.shutdown()
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_vllm_executor_against_stub_server(stub_server, tmp_path, monkeypatch, concurrency):
+    monkeypatch.chdir(tmp_path)
+    base_url, requests = stub_server
+    api_executor = VllmAPIExecutor("stub-model", api_key=None, concurrency=concurrency, base_urls=[base_url])
+    payloads = [
+        {"subject_id": f"s{i}", "temperature": 0.1, "messages": [{"role": "user", "content": f"Subject {i}: {group}"}]}
+        for i, group in enumerate(["HC", "MCI", "HC", "MCI", "HC"])
+    ]
+    test_subject_ids = ["s0", "s1", "s3", "s4"]
+
+    # Concurrency 1 takes the sync path, and greater concurrency the async path
+    responses = api_executor.fetch_response(
+        input_payloads=iter(payloads), test_subject_ids=test_subject_ids, response_path="results/output.jsonl",
+    )
+    assert [r["subject_id"] for r in responses] == test_subject_ids
+    assert [r["diagnosis"] for r in responses] == ["(A)", "(B)", "(B)", "(A)"]
+    assert responses[1] == {
+        "subject_id": "s1", "diagnosis": "(B)", "generated_response": "### Clinical Rationale\nOK.\n\n### Diagnosis\n(B)",
+    }
+    assert len(requests) == 4
+    assert all(path == "/v1/chat/completions" and body["model"] == "stub-model" and body["temperature"] == 0.1
+               for path, body in requests)
+
+    # A re-run resumes from the response log without any requests
+    assert api_executor.fetch_response(
+        input_payloads=payloads, test_subject_ids=test_subject_ids, response_path="results/output.jsonl",
+    ) == responses
+    assert len(requests) == 4
+
+
+def test_vllm_executor_rejects_batch_mode(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api_executor = VllmAPIExecutor("stub-model", api_key=None)
+    with pytest.raises(ValueError, match="Batch mode is not supported"):
+        api_executor.fetch_response(
+            input_payloads=[], test_subject_ids=[], response_path="results/output.jsonl", batch=True,
+        )
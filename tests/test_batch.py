@@ -0,0 +1,132 @@
+import json
+import os
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from lib.api_executor import OpenaiAPIExecutor
+
+
+def completion_result(subject_id, label):
+    return {
+        "custom_id": subject_id, "error": None,
+        "response": {"status_code": 200, "body": {"choices": [{"message": {"content": f"### Diagnosis\n{label}"}}]}},
+    }
+
+
+class FakeBatchClient:
+    """
+    A fake of the OpenAI client's Files and Batch APIs, finishing the batch after one poll.
+    """
+    def __init__(self, output_results, error_results=()):
+        self.uploaded_requests = []
+        self.created_batches = []
+        self.retrieved_batch_ids = []
+        self.file_contents = {
+            "output-file": "\n".join(json.dumps(r) for r in output_results) + "\n",
+            "error-file": "\n".join(json.dumps(r) for r in error_results) + "\n",
+        }
+        self.has_errors = bool(error_results)
+        self.files = SimpleNamespace(
+            create=self._create_file,
+            with_streaming_response=SimpleNamespace(content=self._stream_content),
+        )
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+
+    def _create_file(self, file, purpose):
+        assert purpose == "batch"
+        self.uploaded_requests = [json.loads(line) for line in file.read().splitlines()]
+        return SimpleNamespace(id="input-file")
+
+    def _create_batch(self, input_file_id, endpoint, completion_window):
+        self.created_batches.append(input_file_id)
+        return SimpleNamespace(id="batch-1", status="validating")
+
+    def _retrieve_batch(self, batch_id):
+        self.retrieved_batch_ids.append(batch_id)
+        if len(self.retrieved_batch_ids) == 1:
+            return SimpleNamespace(id=batch_id, status="in_progress", request_counts=SimpleNamespace(completed=0, total=3))
+        return SimpleNamespace(
+            id=batch_id, status="completed", output_file_id="output-file",
+            error_file_id="error-file" if self.has_errors else None,
+        )
+
+    @contextmanager
+    def _stream_content(self, file_id):
+        yield SimpleNamespace(iter_lines=lambda: iter(self.file_contents[file_id].splitlines()))
+
+
+@pytest.fixture
+def api_executor(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api_executor = OpenaiAPIExecutor("gpt-4o", api_key="test")
+    api_executor.batch_poll_interval = 0
+    return api_executor
+
+
+PAYLOADS = [
+    {"subject_id": s, "temperature": 0.1, "messages": [{"role": "user", "content": f"Subject {s}"}]}
+    for s in ("s0", "s1", "s2", "s3")
+]
+
+
+def test_batch_maps_output_and_error_files_to_subjects(api_executor):
+    api_executor.client = FakeBatchClient(
+        output_results=[
+            completion_result("s0", "(A)"),
+            {"custom_id": "s1", "error": None, "response": {
+                "status_code": 400, "body": {"error": {"message": "Context length exceeded", "type": "invalid_request_error"}},
+            }},
+        ],
+        error_results=[{"custom_id": "s2", "response": None, "error": {"code": "batch_expired", "message": "Expired"}}],
+    )
+    response_path = "results/output.jsonl"
+    responses = api_executor.fetch_response(
+        input_payloads=PAYLOADS, test_subject_ids=["s0", "s1", "s2"], response_path=response_path, batch=True,
+    )
+
+    # Only the test subjects are uploaded, with the executor's model and sampling options
+    assert [r["custom_id"] for r in api_executor.client.uploaded_requests] == ["s0", "s1", "s2"]
+    assert all(r["body"]["model"] == "gpt-4o" and r["body"]["temperature"] == 0.1 for r in api_executor.client.uploaded_requests)
+    assert api_executor.client.retrieved_batch_ids == ["batch-1", "batch-1"]
+
+    assert [(r["subject_id"], r["diagnosis"]) for r in responses] == [("s0", "(A)")]
+    with open(f"{response_path}.failed.jsonl") as f:
+        failures = {failure["subject_id"]: failure["error"] for failure in map(json.loads, f)}
+    assert set(failures) == {"s1", "s2"}
+    assert "status 400" in failures["s1"] and "Context length exceeded" in failures["s1"]
+    assert "batch_expired" in failures["s2"]
+
+    # The job's state and input are cleaned up once the results are in
+    assert not os.path.exists(f"{response_path}.batch.json")
+    assert not os.path.exists(f"{response_path}.batch_input.jsonl")
+
+
+def test_batch_resumes_the_submitted_job(api_executor):
+    api_executor.client = FakeBatchClient(output_results=[completion_result("s0", "(A)"), completion_result("s1", "(B)")])
+    response_path = "results/output.jsonl"
+    os.makedirs("results")
+    with open(f"{response_path}.batch.json", "w") as f:
+        json.dump({"batch_id": "batch-0", "input_file_id": "input-file", "status": "in_progress"}, f)
+
+    responses = api_executor.fetch_response(
+        input_payloads=PAYLOADS, test_subject_ids=["s0", "s1"], response_path=response_path, batch=True,
+    )
+    assert api_executor.client.created_batches == []
+    assert api_executor.client.retrieved_batch_ids == ["batch-0", "batch-0"]
+    assert [(r["subject_id"], r["diagnosis"]) for r in responses] == [("s0", "(A)"), ("s1", "(B)")]
+
+
+def test_batch_reuses_cached_responses_without_submitting(api_executor):
+    api_executor.client = FakeBatchClient(output_results=[completion_result("s0", "(A)")])
+    api_executor.fetch_response(
+        input_payloads=PAYLOADS, test_subject_ids=["s0"], response_path="results/first.jsonl", batch=True,
+    )
+
+    api_executor.client = FakeBatchClient(output_results=[])
+    responses = api_executor.fetch_response(
+        input_payloads=PAYLOADS, test_subject_ids=["s0"], response_path="results/second.jsonl", batch=True,
+    )
+    assert api_executor.client.created_batches == []
+    assert responses[0]["diagnosis"] == "(A)" and responses[0]["cached"] is True
@@ -0,0 +1,172 @@
+import asyncio
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import openai
+import pytest
+
+from lib import request_scheduler
+from lib.request_scheduler import RequestScheduler, classify_error, get_retry_after
+
+
+def http_error(status_code, headers=None):
+    request = httpx.Request("POST", "http://localhost/v1/chat/completions")
+    response = httpx.Response(status_code, headers=headers, request=request)
+    return httpx.HTTPStatusError(f"HTTP {status_code}", request=request, response=response)
+
+
+class FakeClock:
+    """
+    A fake of the scheduler's clock and sleep, advancing only when slept or moved.
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+    async def asleep(self, delay):
+        self.sleep(delay)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(request_scheduler.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(request_scheduler.time, "sleep", clock.sleep)
+    monkeypatch.setattr(request_scheduler.asyncio, "sleep", clock.asleep)
+    # Take the upper bound of the jitter, so the delays are deterministic
+    monkeypatch.setattr(request_scheduler.random, "uniform", lambda low, high: high)
+    return clock
+
+
+def test_classify_error():
+    request = httpx.Request("POST", "http://localhost")
+    assert classify_error(http_error(429)) == "rate_limit"
+    assert classify_error(http_error(503)) == "overload"
+    assert classify_error(http_error(500)) == "overload"
+    assert classify_error(http_error(400)) == "fatal"
+    assert classify_error(httpx.ConnectError("refused", request=request)) == "overload"
+    assert classify_error(openai.APIConnectionError(request=request)) == "overload"
+    assert classify_error(ValueError("bad payload")) == "fatal"
+
+
+def test_retry_after():
+    assert get_retry_after(http_error(429, {"retry-after": "7"})) == 7.0
+    assert get_retry_after(http_error(429, {"retry-after-ms": "1500"})) == 1.5
+    assert get_retry_after(http_error(429)) is None
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert 28 <= get_retry_after(http_error(503, {"retry-after": format_datetime(retry_at, usegmt=True)})) <= 30
+
+
+def test_backoff_is_capped_and_respects_retry_after(clock):
+    scheduler = RequestScheduler(max_concurrency=8, base_delay=1.0, max_delay=10.0)
+    assert [scheduler.get_backoff_delay(attempt) for attempt in range(5)] == [1.0, 2.0, 4.0, 8.0, 10.0]
+    assert scheduler.get_backoff_delay(0, retry_after=7.0) == 7.0
+
+
+def test_starts_at_max_concurrency():
+    assert RequestScheduler(max_concurrency=64).concurrency == 64
+    assert RequestScheduler(max_concurrency=64, initial_concurrency=4).concurrency == 4
+
+
+def test_halves_on_rate_limit_and_overload_but_not_on_fatal_errors(clock):
+    scheduler = RequestScheduler(max_concurrency=16)
+    scheduler._on_success(1.0)
+    clock.now += 10
+
+    assert scheduler._on_error(http_error(429), attempt=0) is not None
+    assert scheduler.concurrency == 8
+    # Requests in flight during the same round trip report the same congestion
+    assert scheduler._on_error(http_error(503), attempt=0) is not None
+    assert scheduler.concurrency == 8
+    clock.now += 10
+    assert scheduler._on_error(http_error(503), attempt=0) is not None
+    assert scheduler.concurrency == 4
+
+    assert scheduler._on_error(http_error(400), attempt=0) is None
+    assert scheduler._on_error(http_error(429), attempt=scheduler.max_retries) is None
+    assert scheduler.concurrency == 4
+
+
+def test_grows_additively_after_congestion(clock):
+    scheduler = RequestScheduler(max_concurrency=16, initial_concurrency=2)
+    # Slow start: one more request per success
+    scheduler._on_success(1.0)
+    scheduler._on_success(1.0)
+    assert scheduler.limit == 4.0
+
+    clock.now += 10
+    scheduler._on_error(http_error(429), attempt=0)
+    assert scheduler.limit == 2.0
+    # Congestion avoidance: one more request per round trip of `limit` successes
+    scheduler._on_success(1.0)
+    assert scheduler.limit == 2.5
+    for _ in range(10):
+        scheduler._on_success(1.0)
+    assert scheduler.limit <= 16
+
+
+def test_latency_backoff_is_opt_in(clock):
+    scheduler = RequestScheduler(max_concurrency=16)
+    for latency in [1.0] + [10.0] * 20:
+        scheduler._on_success(latency)
+    assert scheduler.concurrency == 16
+
+    scheduler = RequestScheduler(max_concurrency=16, latency_tolerance=2.0)
+    for latency in [1.0] + [10.0] * 20:
+        clock.now += 10
+        scheduler._on_success(latency)
+    assert scheduler.concurrency < 16
+
+
+def test_call_retries_transient_errors_with_backoff(clock):
+    scheduler = RequestScheduler(max_concurrency=4, base_delay=1.0)
+    errors = [http_error(503), http_error(429, {"retry-after": "5"})]
+
+    def fetch():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert scheduler.call(fetch) == "ok"
+    assert clock.sleeps == [1.0, 5.0]
+
+
+def test_call_raises_fatal_and_exhausted_errors(clock):
+    scheduler = RequestScheduler(max_concurrency=4, max_retries=2)
+
+    def fail(status_code):
+        raise http_error(status_code)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        scheduler.call(fail, 400)
+    assert clock.sleeps == []
+    with pytest.raises(httpx.HTTPStatusError):
+        scheduler.call(fail, 503)
+    assert len(clock.sleeps) == 2
+
+
+def test_acall_limits_in_flight_requests(clock):
+    scheduler = RequestScheduler(max_concurrency=3)
+    in_flight, peak = 0, 0
+
+    async def fetch(i):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.get_running_loop().run_in_executor(None, lambda: None)
+        in_flight -= 1
+        return i
+
+    async def main():
+        return await asyncio.gather(*(scheduler.acall(fetch, i) for i in range(10)))
+
+    assert asyncio.run(main()) == list(range(10))
+    assert peak == 3
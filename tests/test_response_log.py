@@ -0,0 +1,35 @@
+import json
+
+from lib.api_executor import APIExecutor, ResponseLog
+
+
+def write_lines(path, lines):
+    path.write_text("".join(lines), encoding="utf-8")
+
+
+def test_load_truncates_only_unterminated_last_line(tmp_path):
+    response_path = tmp_path / "responses.jsonl"
+    write_lines(response_path, [
+        json.dumps({"subject_id": "a"}) + "\n",
+        '{"subject_id": "b", "diag\n',
+        json.dumps({"subject_id": "c"}) + "\n",
+        '{"subject_id": "d"',
+    ])
+    with ResponseLog(str(response_path)) as response_log:
+        assert "a" in response_log.completed
+        assert "b" not in response_log.completed
+        assert "c" in response_log.completed
+        assert "d" not in response_log.completed
+    assert response_path.read_text(encoding="utf-8").endswith(json.dumps({"subject_id": "c"}) + "\n")
+
+
+def test_failures_are_retried_first(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api_executor = APIExecutor("model", api_key=None)
+    response_path = tmp_path / "responses.jsonl"
+    write_lines(response_path, [json.dumps({"subject_id": "a"}) + "\n"])
+    write_lines(tmp_path / "responses.jsonl.failed.jsonl", [json.dumps({"subject_id": "d", "error": "timeout"}) + "\n"])
+    payloads = [{"subject_id": s} for s in "abcde"]
+    with ResponseLog(str(response_path)) as response_log:
+        pending_payloads = api_executor._iter_pending_payloads(payloads, list("abcde"), response_log, None)
+        assert [p["subject_id"] for p in pending_payloads] == ["d", "b", "c", "e"]
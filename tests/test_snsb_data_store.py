@@ -0,0 +1,18 @@
+from lib.utils import SNSBDataStore
+
+
+def test_lookup_by_subject_id_and_prefix(tmp_path):
+    (tmp_path / "1001.md").write_text("exact", encoding="utf-8")
+    (tmp_path / "1002_b.md").write_text("second", encoding="utf-8")
+    (tmp_path / "1002_a.md").write_text("first", encoding="utf-8")
+    # A write in progress of write_text_atomic
+    (tmp_path / "1003.md.1234.tmp").write_text("partial", encoding="utf-8")
+    data_store = SNSBDataStore({"score": str(tmp_path)})
+
+    assert data_store.get("1001", "score") == "exact"
+    assert data_store.get("1002", "score") == "first"
+    assert data_store.get("1003", "score") is None
+    assert data_store.get("1004", "score") is None
+
+    (tmp_path / "1003.md.1234.tmp").rename(tmp_path / "1003.md")
+    assert data_store.get("1003", "score") == "partial"
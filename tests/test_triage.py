@@ -0,0 +1,45 @@
+import numpy as np
+
+from lib.snsb_scores import SNSBScoreTable
+from lib.triage import TriageClassifier
+
+
+SCORE_DOCUMENT = """| Domain | Test | Raw | Z-score | %ile |
+|---|---|---|---|---|
+| Memory | SVLT delayed recall | {raw} | {z} | 50 |
+| Attention | Digit span forward | 6 | {z} | 50 |
+"""
+
+
+def build_score_table():
+    return SNSBScoreTable.from_documents({
+        "normal": SCORE_DOCUMENT.format(raw=10, z=0.5),
+        "impaired": SCORE_DOCUMENT.format(raw=2, z=-2.5),
+        "missing": None,
+        "unparseable": "The score sheet could not be read.",
+    })
+
+
+def test_subjects_without_z_scores_are_left_to_the_llm():
+    score_table = build_score_table()
+    assert score_table.has_measure("z_score", "normal")
+    assert not score_table.has_measure("z_score", "missing")
+    assert not score_table.has_measure("z_score", "unparseable")
+
+    triage = TriageClassifier(z_cutoff=-1.5, max_normal=0, min_impaired=2)
+    predictions = triage.predict(score_table, ["normal", "impaired", "missing", "unparseable", "unknown"])
+    assert predictions.tolist() == [0, 1, -1, -1, -1]
+
+
+def test_fit_ignores_subjects_without_z_scores():
+    documents = {f"hc{i}": SCORE_DOCUMENT.format(raw=10, z=0.5) for i in range(3)}
+    documents.update({f"mci{i}": SCORE_DOCUMENT.format(raw=2, z=-2.5) for i in range(3)})
+    # Unscored MCI subjects would otherwise count as having no impaired tests and break the (A) rule
+    documents.update({f"missing{i}": None for i in range(3)})
+    score_table = SNSBScoreTable.from_documents(documents)
+    labels = {s: 0 if s.startswith("hc") else 1 for s in documents}
+
+    triage = TriageClassifier.fit(score_table, list(documents), labels, min_precision=1.0)
+    assert triage.max_normal == 0
+    assert triage.min_impaired == 2
+    assert not np.isinf(triage.min_impaired)